@@ -1,11 +1,27 @@
-import os
-from flask import Blueprint, render_template, request, redirect, session, abort, current_app
-from werkzeug.utils import secure_filename
-from database import get_all_items, set_setting, delete_item, get_db
+from datetime import datetime, timedelta
+import csv
+import io
+from flask import (
+    Blueprint, Response, render_template, request, redirect, session, abort, jsonify,
+    stream_with_context
+)
+from database import (
+    set_setting, delete_item, update_item, get_db,
+    search_items, suggest_items, get_categories
+)
+from database import add_item as add_item_to_menu
+import rollups
+import catalogue
+import queries
+import images
+import menuio
 
 
 admin = Blueprint("admin", __name__)
 
+# Items shown per page on the admin dashboard
+PAGE_SIZE = 24
+
 # SECURITY: Barista access only
 # This decorator makes sure ONLY admins can access these routes.
 # If someone tries to sneak in, it will show 403 page.
@@ -21,46 +37,47 @@ def admin_required(func):
 
 
 # Admin dashboard route:
-# Displays all menu items with optional search and category filtering.
+# Displays menu items with optional search and category filtering.
+# Filtering runs in SQL (full-text search, see database.py) and items
+# come one page at a time: ?after=<last id seen> fetches the next page.
 @admin.route("/admin")
 @admin_required
 def admin_dashboard():
 
-    # Fetch all menu items from the database
-    items = get_all_items()
-
-    # Extract unique categories for the filter dropdown
-    categories = sorted({item["category"] for item in items})
-
     # Read filter values from query parameters
-    search = request.args.get("search", "").strip().lower()
+    search = request.args.get("search", "").strip()
     category = request.args.get("category", "").strip()
+    after = request.args.get("after", 0, type=int)
 
-    # Start with all items
-    filtered_items = items
+    # Ask for one extra row to find out whether there is a next page
+    items = search_items(search, category, after, PAGE_SIZE + 1)
+    next_after = items[PAGE_SIZE - 1]["id"] if len(items) > PAGE_SIZE else None
+    items = items[:PAGE_SIZE]
 
-    # Filter by name if search text is provided
-    if search:
-        filtered_items = [
-            item for item in filtered_items
-            if search in item["name"].lower()
-        ]
-
-    # Filter by category if one is selected
-    if category:
-        filtered_items = [
-            item for item in filtered_items
-            if item["category"] == category
-        ]
+    # Unique categories for the filter dropdown
+    categories = get_categories()
 
     # Render dashboard with filtered results
     return render_template(
         "admin/dashboard.html",
-        items=filtered_items,
-        categories=categories
+        items=items,
+        categories=categories,
+        next_after=next_after,
+        after=after
     )
 
 
+# Item search route (AJAX):
+# Returns the best matching items as JSON for type-ahead search boxes.
+@admin.route("/admin/search")
+@admin_required
+def admin_search():
+    text = request.args.get("q", "")
+    limit = min(request.args.get("limit", 10, type=int), 50)
+
+    return jsonify([dict(row) for row in suggest_items(text, limit)])
+
+
 # Add new menu item route:
 # Shows form on GET and saves new item on POST.
 @admin.route("/admin/add", methods=["GET", "POST"])
@@ -78,28 +95,12 @@ def add_item():
         filename = None
 
         if image_file and image_file.filename != "":
-            # Make filename safe for filesystem
-            filename = secure_filename(image_file.filename)
-
-            # Build full upload path
-            file_path = os.path.join(
-                current_app.config["UPLOAD_FOLDER"],
-                filename
-            )
-
-            # Save image file to disk
-            image_file.save(file_path)
-
-            # Store relative path for use in templates
-            filename = f"uploads/{filename}"
+            # Stored by content hash, resized copies are made in the
+            # background (see images.py). Returns the path for templates.
+            filename = images.save_upload(image_file)
 
-        # Insert new item into database
-        db = get_db()
-        db.execute("""
-            INSERT INTO menu_items (name, price, category, description, image)
-            VALUES (?, ?, ?, ?, ?)
-        """, (name, price, category, description, filename))
-        db.commit()
+        # Insert new item into database (also refreshes the catalogue)
+        add_item_to_menu(name, price, category, description, filename)
 
         return redirect("/admin")
 
@@ -112,13 +113,8 @@ def add_item():
 @admin.route("/admin/edit/<int:item_id>", methods=["GET", "POST"])
 @admin_required
 def edit_item(item_id):
-    db = get_db()
-
     # Load existing item data
-    item = db.execute(
-        "SELECT * FROM menu_items WHERE id=?",
-        (item_id,)
-    ).fetchone()
+    item = catalogue.get_item(item_id)
 
     if request.method == "POST":
         # Read updated form values
@@ -132,23 +128,10 @@ def edit_item(item_id):
 
         # Replace image if a new file is uploaded
         if image_file and image_file.filename != "":
-            filename_new = secure_filename(image_file.filename)
-            file_path = os.path.join(
-                current_app.config["UPLOAD_FOLDER"],
-                filename_new
-            )
-            image_file.save(file_path)
-
-            filename = f"uploads/{filename_new}"
-
-        # Update item in database
-        db.execute("""
-            UPDATE menu_items
-            SET name=?, price=?, category=?, description=?, image=?
-            WHERE id=?
-        """, (name, price, category, description, filename, item_id))
-
-        db.commit()
+            filename = images.save_upload(image_file)
+
+        # Update item in database (also refreshes the catalogue)
+        update_item(item_id, name, price, category, description, filename)
         return redirect("/admin")
 
     # GET request to show edit form with existing data
@@ -170,52 +153,161 @@ def admin_delete_item(item_id):
 @admin_required
 def admin_change_theme():
     theme = request.form["theme"]
+
+    # Also refreshes this worker's cached settings
     set_setting("theme", theme)
     return redirect("/admin")
 
 
+# Bulk import route (see menuio.py):
+# Takes a CSV / JSON Lines file from the form (shows the report page),
+# or as the raw request body (returns the report as JSON), e.g.
+#   curl --data-binary @menu.csv -H "Content-Type: text/csv" .../admin/import
+@admin.route("/admin/import", methods=["GET", "POST"])
+@admin_required
+def import_menu():
+    if request.method == "GET":
+        return render_template("admin/import.html", report=None)
+
+    upload = request.files.get("file")
+    from_form = upload is not None
+    if upload and upload.filename:
+        stream, filename = upload.stream, upload.filename
+    else:
+        stream, filename = request.stream, ""
+
+    fmt = menuio.guess_format(request.values.get("format"), filename)
+
+    # Decoded as it is read, the file is never held in memory whole
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    report = menuio.new_report()
+    try:
+        menuio.import_menu(text, fmt, report)
+    except (UnicodeDecodeError, csv.Error) as e:
+        # Chunks before the broken part are already saved
+        error = f"Could not read the file: {e}"
+        if from_form:
+            return render_template("admin/import.html", report=report, error=error), 400
+        return jsonify({"error": error, "imported": report["imported"]}), 400
+
+    if not from_form:
+        return jsonify(report)
+    return render_template("admin/import.html", report=report)
+
+
+# Export routes:
+# Stream the menu or the order history (one row per order line) as
+# CSV or JSON Lines, straight from the database cursor.
+# Orders can be limited with ?start=YYYY-MM-DD&end=YYYY-MM-DD.
+def export_response(chunks, name, fmt):
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={name}.{fmt}"}
+    )
+
+
+@admin.route("/admin/export/menu")
+@admin_required
+def export_menu():
+    fmt = menuio.guess_format(request.args.get("format"))
+    return export_response(menuio.export_menu(fmt), "menu", fmt)
+
+
+@admin.route("/admin/export/orders")
+@admin_required
+def export_orders():
+    fmt = menuio.guess_format(request.args.get("format"))
+    start = date_arg("start")
+    end = date_arg("end")
+
+    chunks = menuio.export_orders(
+        fmt,
+        start.isoformat() if start else "0000-00-00",
+        (end + timedelta(days=1)).isoformat() if end else "9999-99-99"
+    )
+    return export_response(chunks, "orders", fmt)
+
+
+# Reads a "YYYY-MM-DD" query parameter, None if missing or invalid
+def date_arg(name):
+    try:
+        return datetime.strptime(request.args.get(name, ""), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
 # Analytics dashboard route:
 # Displays statistics such as popular items and order counts.
+# Everything comes from the rollup tables (see rollups.py), so the
+# page costs the same no matter how many orders have been placed.
+# Optional ?start=YYYY-MM-DD&end=YYYY-MM-DD limits the date range.
 @admin.route("/admin/analytics")
 @admin_required
 def analytics_dashboard():
     db = get_db()
 
+    start = date_arg("start")
+    end = date_arg("end")
+
+    # Bucket labels compare as text, end is made exclusive
+    range_start = start.isoformat() if start else "0000-00-00"
+    range_end = (end + timedelta(days=1)).isoformat() if end else "9999-99-99"
+
     # Most popular items:
     # Counts how often each item appears in orders
-    popular_items = [
-        (row[0], row[1])
-        for row in db.execute("""
-            SELECT json_extract(value, '$.name') AS name,
-                   COUNT(*) AS count
-            FROM orders, json_each(orders.items)
-            GROUP BY name
-            ORDER BY count DESC
-        """).fetchall()
-    ]
-
-    # Orders per day:
-    # Used for traffic trends over time
-    orders_per_day = [
-        (row[0], row[1])
-        for row in db.execute("""
-            SELECT DATE(created_at) AS day,
-                   COUNT(*) AS count
-            FROM orders
-            GROUP BY day
-            ORDER BY day
-        """).fetchall()
-    ]
-
-    # Total number of orders
-    total_orders = db.execute(
-        "SELECT COUNT(*) FROM orders"
-    ).fetchone()[0]
+    popular_items = rollups.get_popular_items(db, range_start, range_end)
+
+    # Orders over time:
+    # Short ranges (up to 2 days) are shown per hour, longer ones per day
+    if start and end and (end - start).days < 2:
+        grain = "hour"
+    else:
+        grain = "day"
+
+    orders_over_time = rollups.get_orders_per_bucket(db, grain, range_start, range_end)
+
+    # Total number of orders and revenue
+    total_orders, total_revenue = rollups.get_totals(db, range_start, range_end)
+
+    # Busiest hours of the day
+    orders_by_hour = rollups.get_orders_by_hour(db, range_start, range_end)
+
+    # Order timings:
+    # How long orders wait in each stage (p50/p95), and how many were
+    # waiting in each at the end of every hour/day
+    stage_timings = rollups.get_stage_timings(db, grain, range_start, range_end)
+    queue_depth = rollups.get_queue_depth(db, grain, range_start, range_end)
 
     # Render analytics page
     return render_template(
         "admin/analytics.html",
         popular_items=popular_items,
-        orders_per_day=orders_per_day,
-        total_orders=total_orders
+        orders_over_time=orders_over_time,
+        grain=grain,
+        total_orders=total_orders,
+        total_revenue=total_revenue,
+        orders_by_hour=orders_by_hour,
+        stages=rollups.STAGES,
+        stage_timings=stage_timings,
+        stage_limit=queries.STAGE_BOUNDS[-1],
+        queue_depth=queue_depth,
+        start=start,
+        end=end
     )
+
+
+# Query metrics routes:
+# Call counts, latency percentiles and rows returned for every named
+# query (see queries.py). Stats are per worker process.
+@admin.route("/admin/metrics")
+@admin_required
+def query_metrics():
+    return render_template("admin/metrics.html", stats=queries.get_stats())
+
+
+@admin.route("/admin/metrics.json")
+@admin_required
+def query_metrics_json():
+    return jsonify(queries.get_stats())
@@ -0,0 +1,64 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+import queries
+
+
+# Order archival:
+# Collected orders older than [archive] after_days (and their lines)
+# are moved from orders / order_items into orders_archive /
+# order_items_archive. The barista board, status updates and checkout
+# only ever touch the live tables, which stay small; rollup rebuilds
+# and order exports read both through the all_orders / all_order_items
+# views, so no history is lost to analytics.
+#
+# Orders move in batches of [archive] batch_size, each in its own short
+# transaction with a pause in between, so checkouts and status updates
+# never wait long for the write lock.
+#
+# Run it from cron: flask --app main archive-orders
+
+
+# Orders created before this are old enough to archive.
+# (created_at is stored in UTC by SQLite's CURRENT_TIMESTAMP)
+def cutoff_for(days):
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Moves one batch, returns how many orders were moved
+def archive_batch(db, cutoff, batch_size):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        ids = [row[0] for row in queries.fetch_all(db, "archive.pick", (cutoff, batch_size))]
+
+        if ids:
+            ids_json = json.dumps(ids)
+            queries.execute(db, "archive.copy_orders", (ids_json,))
+            queries.execute(db, "archive.copy_items", (ids_json,))
+            queries.execute(db, "archive.delete_items", (ids_json,))
+            queries.execute(db, "archive.delete_orders", (ids_json,))
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return len(ids)
+
+
+# Archives everything old enough, batch by batch.
+# Returns the total number of orders moved.
+def archive_orders(db, days, batch_size, pause=0.0):
+    cutoff = cutoff_for(days)
+    total = 0
+
+    while True:
+        moved = archive_batch(db, cutoff, batch_size)
+        total += moved
+
+        if moved < batch_size:
+            return total
+
+        # Let waiting writers in before the next batch
+        time.sleep(pause)
@@ -0,0 +1,112 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from flask import Blueprint, Response, abort, current_app, request, send_from_directory, url_for
+
+# Brotli is optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Static asset fingerprinting:
+# At startup every stylesheet, theme and image under static/ gets a
+# content-hashed name (styles.css -> styles.3f2a1b9c0d.css). Templates
+# link to those names through asset_url(), and /assets/ serves them
+# with a one-year "immutable" Cache-Control, so browsers never
+# revalidate them. Changing a file (or switching theme) changes the
+# URL, which is all the invalidation we need.
+#
+# CSS/JS/SVG are also gzip (and brotli, if installed) compressed once
+# at startup and served pre-compressed to browsers that accept it.
+assets = Blueprint("assets", __name__)
+
+# Which files under static/ get fingerprinted (uploads already are)
+FINGERPRINTED = ("styles.css", "themes/", "img/")
+COMPRESSIBLE = {".css", ".js", ".svg"}
+MAX_AGE = 365 * 24 * 60 * 60
+
+_manifest = {}  # "styles.css" -> entry (see fingerprint)
+_reverse = {}   # "styles.3f2a1b9c0d.css" -> "styles.css"
+
+
+def fingerprint(static_folder, logical):
+    path = os.path.join(static_folder, logical)
+    with open(path, "rb") as f:
+        data = f.read()
+
+    base, ext = os.path.splitext(logical)
+    entry = {
+        "name": f"{base}.{hashlib.sha256(data).hexdigest()[:10]}{ext}",
+        "mtime": os.stat(path).st_mtime,
+        "encoded": {},
+    }
+
+    if ext in COMPRESSIBLE:
+        entry["encoded"]["gzip"] = gzip.compress(data, 9, mtime=0)
+        if brotli is not None:
+            entry["encoded"]["br"] = brotli.compress(data)
+
+    return entry
+
+
+def add_entry(logical, entry):
+    # A re-fingerprinted file's old name must stop working, or it would
+    # serve the new content as "immutable"
+    previous = _manifest.get(logical)
+    if previous is not None and previous["name"] != entry["name"]:
+        _reverse.pop(previous["name"], None)
+
+    _manifest[logical] = entry
+    _reverse[entry["name"]] = logical
+
+
+# Hashes every fingerprinted file, called once at startup (main.py)
+def build_manifest(app):
+    static_folder = app.static_folder
+
+    for root, _, files in os.walk(static_folder):
+        for file in files:
+            logical = os.path.relpath(os.path.join(root, file), static_folder).replace(os.sep, "/")
+            if logical.startswith(FINGERPRINTED):
+                add_entry(logical, fingerprint(static_folder, logical))
+
+
+# Template helper: URL for a file under static/.
+# Fingerprinted files get their /assets/ URL, anything else (uploads,
+# files added after startup) falls back to the normal static URL.
+def asset_url(logical):
+    entry = _manifest.get(logical)
+    if entry is None:
+        return url_for("static", filename=logical)
+
+    # While developing, pick up edited files without a restart
+    if current_app.debug:
+        path = os.path.join(current_app.static_folder, logical)
+        if os.path.exists(path) and os.stat(path).st_mtime != entry["mtime"]:
+            entry = fingerprint(current_app.static_folder, logical)
+            add_entry(logical, entry)
+
+    return url_for("assets.asset", filename=entry["name"])
+
+
+@assets.route("/assets/<path:filename>")
+def asset(filename):
+    logical = _reverse.get(filename)
+    if logical is None:
+        abort(404)
+
+    entry = _manifest[logical]
+    encoding = request.accept_encodings.best_match(list(entry["encoded"]))
+
+    if encoding:
+        response = Response(entry["encoded"][encoding], mimetype=mimetypes.guess_type(logical)[0])
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = send_from_directory(current_app.static_folder, logical)
+
+    response.headers["Cache-Control"] = f"public, max-age={MAX_AGE}, immutable"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
@@ -1,6 +1,8 @@
-from flask import Blueprint, render_template, request, redirect, session
+from flask import Blueprint, render_template, request, redirect, session, current_app
 from database import get_db
-from werkzeug.security import check_password_hash
+import queries
+import passwords
+import ratelimit
 
 
 auth = Blueprint('auth', __name__)
@@ -9,6 +11,11 @@ auth = Blueprint('auth', __name__)
 # Login route:
 # Handles both the login form display (GET)
 # and the actual login authentication (POST).
+#
+# Before any password is checked, the visitor's IP and the username
+# each have to get past a rate limit (see ratelimit.py), so scripted
+# guessing can't keep the hashing busy. The check itself runs on the
+# bounded hashing pool (see passwords.py).
 @auth.route("/login", methods=["GET", "POST"])
 def login():
     error = None
@@ -17,16 +24,41 @@ def login():
         username = request.form["username"]
         password = request.form["password"]
 
+        config = current_app.config
+
+        # Per IP first, so one address can't use up a user's attempts
+        retry_after = ratelimit.take(f"ip:{request.remote_addr}",
+                                     config["LOGIN_IP_BURST"], config["LOGIN_IP_PER_MINUTE"])
+        if not retry_after:
+            retry_after = ratelimit.take(f"user:{username.lower()}",
+                                         config["LOGIN_USER_BURST"], config["LOGIN_USER_PER_MINUTE"])
+        if retry_after:
+            error = f"Too many login attempts, please try again in {int(retry_after) + 1} seconds"
+            return render_template("login.html", error=error), 429, {"Retry-After": str(int(retry_after) + 1)}
+
         db = get_db()
 
         # Try to find a user with that username
-        user = db.execute(
-            "SELECT * FROM users WHERE username = ?",
-            (username,)
-        ).fetchone()
+        user = queries.fetch_one(db, "users.by_username", (username,))
+
+        try:
+            valid = passwords.check_password(user["password"] if user else None, password)
+        except passwords.PoolBusy:
+            error = "We're busy right now, please try again in a moment"
+            return render_template("login.html", error=error), 503, {"Retry-After": "5"}
 
         # If user exists AND the hashed password matches then log them in
-        if user and check_password_hash(user["password"], password):
+        if valid:
+
+            # Stored with an older method / work factor: upgrade it now
+            # that we have the plain password (or on a later login, if
+            # the hashing pool is busy)
+            try:
+                if passwords.needs_rehash(user["password"]):
+                    queries.execute(db, "users.set_password", (passwords.hash_password(password), user["id"]))
+                    db.commit()
+            except passwords.PoolBusy:
+                pass
 
             # Store who is logged in + their role
             session["user_id"] = user["id"]
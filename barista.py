@@ -1,9 +1,26 @@
-from flask import Blueprint, render_template, session, abort, request, jsonify 
-from database import get_orders, update_order_status
+import json
+import queue
+import time
+from flask import (
+    Blueprint, render_template, session, abort, request, jsonify,
+    current_app, Response, stream_with_context
+)
+import cards
+import events
+from database import (
+    get_active_orders, get_orders_changed_since, get_order_cursor, get_order,
+    update_order_status, update_order_statuses
+)
 
 # Setting up the blueprint so everything here sits under /barista
 barista = Blueprint("barista", __name__, url_prefix="/barista")
 
+# Max number of changed orders sent back in one delta response
+DELTA_LIMIT = 500
+
+# Max number of status changes accepted in one batch
+BATCH_LIMIT = 100
+
 
 # SECURITY: Barista access only
 # This decorator makes sure ONLY baristas can access these routes.
@@ -22,27 +39,210 @@ def barista_required(func):
 @barista.route("/")
 @barista_required
 def dashboard():
-    # Fetch all orders from the database (pending, progress, ready, collected)
-    orders = get_orders()
+    # Read the cursor first: anything that changes while we load the
+    # orders will be picked up again by the first delta request.
+    cursor = get_order_cursor()
+
+    # Only the orders still being worked on (pending, progress, ready)
+    orders = get_active_orders()
+
+    # Render the barista dashboard with the current orders, each card
+    # comes ready-made from the card cache (see cards.py)
+    return render_template("barista/dashboard.html", orders=orders,
+                           cards=cards.get_cards(orders), cursor=cursor)
+
+
+# Turns an order row into JSON for the dashboard.
+# The card HTML is rendered server-side (and cached, see cards.py) so
+# the page can drop it straight into the right column.
+def order_to_json(o):
+    return {
+        "id": o["id"],
+        "status": o["status"],
+        "version": o["version"],
+        "change_seq": o["change_seq"],
+        "html": cards.get_card(o)["html"],
+    }
+
+
+# Order delta feed (AJAX)
+# Returns only the orders that changed after the "since" cursor,
+# so refreshing the board costs the same no matter how many orders
+# have been placed over time.
+@barista.route("/orders")
+@barista_required
+def order_changes():
+    since = request.args.get("since", type=int)
+
+    more = False
 
-    # Render the barista dashboard with the current orders
-    return render_template("barista/dashboard.html", orders=orders)
+    # No cursor yet: send a snapshot of the active orders instead
+    if since is None:
+        cursor = get_order_cursor()
+        orders = get_active_orders()
+    else:
+        orders = get_orders_changed_since(since, DELTA_LIMIT)
+        cursor = orders[-1]["change_seq"] if orders else since
+
+        # A full page means there may be more waiting
+        more = len(orders) == DELTA_LIMIT
+
+    return jsonify({
+        "cursor": cursor,
+        "more": more,
+        "orders": [order_to_json(o) for o in orders],
+    })
 
 
 
 # Update order status (AJAX)
-# This is triggered when a barista drags a card into another column.
-# It updates the order status in the database instantly.
+# Moves one order. Kept for simple clients, the dashboard itself
+# sends its moves in batches to /barista/update-many.
 @barista.route("/update", methods=["POST"])
 @barista_required
 def update_status():
-    data = request.json  # receive the JSON sent from JS drag and drop
+    data = request.get_json(silent=True)  # receive the JSON sent from JS drag and drop
+
+    # Which order is being moved, where to, and (optionally) the
+    # version the client last saw
+    try:
+        order_id = int(data["order_id"])
+        status = str(data["status"])
+        version = int(data["version"]) if data.get("version") is not None else None
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify({"success": False, "error": "needs an order_id and a status"}), 400
 
-    order_id = data["order_id"]        # which order is being moved
-    new_status = data["status"]        # where the order was dropped
+    result = update_order_status(order_id, status, version)
 
-    # Update the database with the new status
-    update_order_status(order_id, new_status)
+    if not result["ok"]:
+        return jsonify({"success": False, "error": result["error"]}), 409
+
+    # Its cached card is for the old version now
+    cards.forget(result["order_id"])
 
     # Send an "ok!" back to JavaScript
     return jsonify({"success": True})
+
+
+# Batch status update (AJAX)
+# Body: {"changes": [{"order_id", "status", "version"}, ...]}
+# All changes are applied in one transaction, in order. Each one is
+# checked against the state machine and the order's version (see
+# database.py); rejected ones come back with the order as it really
+# is, so the board can put the card back where it belongs.
+@barista.route("/update-many", methods=["POST"])
+@barista_required
+def update_statuses():
+    changes = (request.get_json(silent=True) or {}).get("changes")
+
+    if not isinstance(changes, list) or len(changes) > BATCH_LIMIT:
+        return jsonify({"error": f"changes must be a list of at most {BATCH_LIMIT} moves"}), 400
+
+    try:
+        changes = [
+            {"order_id": int(c["order_id"]), "status": str(c["status"]),
+             "version": int(c["version"]) if c.get("version") is not None else None}
+            for c in changes
+        ]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "each change needs an order_id and a status"}), 400
+
+    results = update_order_statuses(changes)
+
+    for result in results:
+        if result["ok"]:
+            cards.forget(result["order_id"])
+        elif result["error"] != "missing":
+            result["order"] = order_to_json(get_order(result["order_id"]))
+
+    return jsonify({"results": results})
+
+
+# Formats one order as a Server-Sent Event.
+# The event id is the change_seq so a reconnecting browser can
+# tell us where it left off (Last-Event-ID).
+def order_event(o):
+    return f"id: {o['change_seq']}\ndata: {json.dumps(order_to_json(o))}\n\n"
+
+
+# Live order stream (Server-Sent Events)
+# Keeps one connection open per tablet and pushes each order the
+# moment it changes, so every tablet stays in sync without reloading.
+#
+# backend = memory: wait on the in-process events bus, SQLite is only
+#                   read to catch up after connecting, falling behind
+#                   or every keepalive seconds without an event.
+# backend = sqlite: tail the orders table by change_seq every
+#                   poll_interval seconds (works across worker processes).
+@barista.route("/stream")
+@barista_required
+def order_stream():
+    cursor = request.headers.get("Last-Event-ID", type=int)
+    if cursor is None:
+        cursor = request.args.get("since", type=int)
+
+    # No cursor at all: start from now rather than replaying every
+    # order ever placed (the page already has the current ones)
+    if cursor is None:
+        cursor = get_order_cursor()
+
+    backend = current_app.config["EVENTS_BACKEND"]
+    poll_interval = current_app.config["EVENTS_POLL_INTERVAL"]
+    keepalive = current_app.config["EVENTS_KEEPALIVE"]
+
+    def generate(cursor):
+        q = events.subscribe() if backend == "memory" else None
+        catch_up = True
+        idle = 0
+
+        try:
+            while True:
+                # Read whatever we missed straight from the database
+                if catch_up:
+                    orders = get_orders_changed_since(cursor, DELTA_LIMIT)
+                    for o in orders:
+                        yield order_event(o)
+                    if orders:
+                        cursor = orders[-1]["change_seq"]
+
+                    # Keep reading while the pages come back full
+                    catch_up = len(orders) == DELTA_LIMIT
+                    if catch_up:
+                        continue
+
+                if q is None:
+                    time.sleep(poll_interval)
+                    catch_up = True
+
+                    idle += poll_interval
+                    if idle >= keepalive:
+                        idle = 0
+                        yield ": keepalive\n\n"
+                    continue
+
+                # Quiet for a while: also re-read the database, the bus
+                # never hears about changes made by other processes
+                # (other workers, the CLI)
+                try:
+                    order = q.get(timeout=keepalive)
+                except queue.Empty:
+                    catch_up = True
+                    yield ": keepalive\n\n"
+                    continue
+
+                # None = we fell behind, anything but the very next change_seq
+                # = events arrived out of order. Both resync from the database.
+                if order is None or order["change_seq"] > cursor + 1:
+                    catch_up = True
+                elif order["change_seq"] == cursor + 1:
+                    cursor = order["change_seq"]
+                    yield order_event(order)
+        finally:
+            if q is not None:
+                events.unsubscribe(q)
+
+    return Response(
+        stream_with_context(generate(cursor)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
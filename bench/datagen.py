@@ -0,0 +1,150 @@
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import rollups  # noqa: E402
+
+
+# Synthetic data for the benchmarks:
+# Builds a fresh database with init_db.py's schema, then fills it with
+# a generated catalogue and order history. The same scale and seed
+# always give the same data, so runs can be compared.
+
+# orders, menu items, days of history
+SCALES = {
+    "small": {"orders": 1_000, "items": 50, "days": 30},
+    "medium": {"orders": 100_000, "items": 500, "days": 365},
+    "large": {"orders": 1_000_000, "items": 2_000, "days": 3 * 365},
+}
+
+CATEGORIES = ["Drinks", "Cake", "Pastries", "Sandwiches", "Board Games", "Seasonal"]
+WORDS = ["Vanilla", "Caramel", "Mocha", "Matcha", "Chai", "Lemon", "Berry",
+         "Hazelnut", "Pumpkin", "Ginger", "Toffee", "Almond", "Coconut", "Maple"]
+
+# Orders still on the barista board (pending / progress / ready)
+ACTIVE_ORDERS = 40
+BATCH_SIZE = 10_000
+
+# Seconds an order typically spends in each stage (lognormal mu, sigma)
+STAGE_TIMES = {"pending": (5.0, 0.6), "progress": (5.5, 0.4), "ready": (4.5, 0.8)}
+STATUSES = ["pending", "progress", "ready", "collected"]
+
+
+def make_items(rng, count):
+    items = []
+    for i in range(count):
+        name = f"{rng.choice(WORDS)} {rng.choice(WORDS)} #{i + 1}"
+        items.append((i + 1, name, round(rng.uniform(1.5, 6.5), 2),
+                       rng.choice(CATEGORIES), f"Generated item {i + 1}.", "img/slideshow4.png"))
+    return items
+
+
+# Transition log rows taking an order from created to status
+def make_transitions(rng, order_id, created, status):
+    rows = [(order_id, None, "pending", created.strftime("%Y-%m-%d %H:%M:%S"))]
+    at = created
+    for old, new in zip(STATUSES, STATUSES[1:STATUSES.index(status) + 1]):
+        at += timedelta(seconds=rng.lognormvariate(*STAGE_TIMES[old]))
+        rows.append((order_id, old, new, at.strftime("%Y-%m-%d %H:%M:%S")))
+    return rows
+
+
+def make_orders(rng, items, count, days, timings):
+    start = datetime.now() - timedelta(days=days)
+    step = days * 86400 / count
+
+    for order_id in range(1, count + 1):
+        created = start + timedelta(seconds=order_id * step)
+        lines = [rng.choice(items) for _ in range(rng.randint(1, 4))]
+        lines = [(item, rng.randint(1, 3)) for item in dict.fromkeys(lines)]
+
+        if order_id > count - ACTIVE_ORDERS:
+            status = rng.choice(["pending", "progress", "ready"])
+        else:
+            status = "collected"
+
+        items_json = json.dumps([{"name": item[1], "qty": qty} for item, qty in lines])
+        order = (order_id, "Customer", items_json, status,
+                 created.strftime("%Y-%m-%d %H:%M:%S"), order_id)
+        order_items = [(order_id, item[0], item[1], qty, item[2]) for item, qty in lines]
+        yield order, order_items, make_transitions(timings, order_id, created, status)
+
+
+# Creates (or replaces) path with scale's data, returns path
+def generate(path, scale, seed=1):
+    sizes = SCALES[scale]
+    rng = random.Random(seed)
+    timings = random.Random(-seed)  # separate, so the orders stay the same
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    # The real schema, straight from init_db.py
+    subprocess.run([sys.executable, "init_db.py", path], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+
+    items = make_items(rng, sizes["items"])
+
+    with db:
+        db.execute("DELETE FROM menu_items")
+        db.executemany("""
+            INSERT INTO menu_items (id, name, price, category, description, image)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, items)
+
+        orders, order_items, transitions = [], [], []
+        for order, lines, steps in make_orders(rng, items, sizes["orders"], sizes["days"], timings):
+            orders.append(order)
+            order_items += lines
+            transitions += steps
+
+            if len(orders) >= BATCH_SIZE:
+                insert_orders(db, orders, order_items, transitions)
+                orders, order_items, transitions = [], [], []
+
+        insert_orders(db, orders, order_items, transitions)
+
+    rollups.rebuild(db)
+    db.execute("ANALYZE")
+    db.close()
+    return path
+
+
+def insert_orders(db, orders, order_items, transitions):
+    db.executemany("""
+        INSERT INTO orders (id, customer_name, items, status, created_at, change_seq)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, orders)
+    db.executemany("""
+        INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price)
+        VALUES (?, ?, ?, ?, ?)
+    """, order_items)
+    db.executemany("""
+        INSERT INTO order_transitions (order_id, from_status, to_status, at)
+        VALUES (?, ?, ?, ?)
+    """, transitions)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a benchmark database.")
+    parser.add_argument("path")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.path, args.scale, args.seed)
+    print(f"Wrote {args.scale} data to {args.path}")
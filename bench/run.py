@@ -0,0 +1,365 @@
+import argparse
+import glob
+import http.client
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from datagen import SCALES, generate  # noqa: E402
+
+
+# Benchmark suite:
+# Generates a synthetic database (see datagen.py), points the app at it
+# and times the storefront, checkout and barista paths two ways:
+#   test_client  one request at a time through Flask's test client
+#                (app + database cost only, no network)
+#   http         a local threaded server hit by --concurrency clients
+#                over keep-alive HTTP connections for --duration seconds
+#
+# Each endpoint gets throughput and p50/p95/p99 latency. Results are
+# saved as JSON under bench/results/ and compared with the previous run
+# at the same scale (or --baseline); endpoints whose p95 or throughput
+# got worse by more than --threshold are flagged as regressions.
+#
+#   python bench/run.py --scale small
+#   python bench/run.py --scale medium --concurrency 16 --fail-on-regression
+#   python bench/run.py --db /tmp/bench.db    reuse a generated database
+
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+WARMUP = 10
+
+
+# name -> (method, path, session role or None)
+# Checkout is special: every request first fills a cart (untimed).
+SCENARIOS = {
+    "home": ("GET", "/", None),
+    "menu": ("GET", "/menu", None),
+    "menu_304": ("GET", "/menu", None),
+    "cart_add_many": ("POST", "/cart/add-many", None),
+    "checkout": ("POST", "/checkout", None),
+    "barista_dashboard": ("GET", "/barista/", "barista"),
+    "barista_orders": ("GET", "/barista/orders?since={since}", "barista"),
+    "admin_analytics": ("GET", "/admin/analytics", "admin"),
+}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def summarise(latencies, errors, elapsed):
+    samples = sorted(latencies)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(sum(samples) * 1000 / len(samples), 3) if samples else 0.0,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3) if samples else 0.0,
+    }
+
+
+# A signed session cookie value for the given role, no login needed
+def session_cookie(app, role):
+    return app.session_interface.get_signing_serializer(app).dumps({"role": role})
+
+
+def request_body(name):
+    if name == "cart_add_many":
+        return {"items": {"1": 1, "2": 2}}
+    if name == "checkout":
+        return {"checkout_key": uuid.uuid4().hex}
+    return None
+
+
+# Test client driver
+def run_test_client(app, name, path, role, count):
+    method = SCENARIOS[name][0]
+    client = app.test_client()
+    if role:
+        client.set_cookie("session", session_cookie(app, role))
+
+    etag = client.get("/menu").headers.get("ETag") if name == "menu_304" else None
+    headers = {"If-None-Match": etag} if etag else {}
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+
+    for i in range(WARMUP + count):
+        if name == "checkout":
+            client.post("/cart/add-many", json=request_body("cart_add_many"))
+
+        body = request_body(name)
+        start = time.perf_counter()
+        if method == "GET":
+            response = client.get(path, headers=headers)
+        elif name == "checkout":
+            response = client.post(path, data=body)
+        else:
+            response = client.post(path, json=body)
+        seconds = time.perf_counter() - start
+
+        if i == WARMUP - 1:
+            started = time.perf_counter()
+        if i < WARMUP:
+            continue
+
+        if response.status_code >= 400:
+            errors += 1
+        latencies.append(seconds)
+
+    return summarise(latencies, errors, time.perf_counter() - started)
+
+
+# HTTP driver: one keep-alive connection (and cookie) per client thread
+class HttpClient:
+    def __init__(self, port, cookie=None):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        self.cookie = cookie
+
+    def request(self, method, path, json_body=None, form=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body)
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            body = "&".join(f"{k}={v}" for k, v in form.items())
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = f"session={self.cookie}"
+
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+
+        for header, value in response.getheaders():
+            if header.lower() == "set-cookie" and value.startswith("session="):
+                self.cookie = value.split(";", 1)[0].split("=", 1)[1]
+
+        return response
+
+
+def run_http(app, port, name, path, role, duration, concurrency):
+    method = SCENARIOS[name][0]
+    cookie = session_cookie(app, role) if role else None
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = [0.0]
+    ready = threading.Barrier(concurrency + 1)
+
+    def worker():
+        client = HttpClient(port, cookie)
+        headers = {}
+        if name == "menu_304":
+            etag = client.request("GET", "/menu").getheader("ETag")
+            headers["If-None-Match"] = etag
+
+        ready.wait()
+        mine, my_errors = [], 0
+        while time.perf_counter() < deadline[0]:
+            if name == "checkout":
+                client.request("POST", "/cart/add-many", json_body=request_body("cart_add_many"))
+
+            start = time.perf_counter()
+            try:
+                if method == "GET":
+                    response = client.request("GET", path, headers=headers)
+                elif name == "checkout":
+                    response = client.request("POST", path, form=request_body(name))
+                else:
+                    response = client.request("POST", path, json_body=request_body(name))
+                failed = response.status >= 400
+            except (OSError, http.client.HTTPException):
+                client = HttpClient(port, client.cookie)
+                failed = True
+            mine.append(time.perf_counter() - start)
+            my_errors += failed
+
+        with lock:
+            latencies.extend(mine)
+            errors[0] += my_errors
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    deadline[0] = time.perf_counter() + duration
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+
+    return summarise(latencies, errors[0], time.perf_counter() - started)
+
+
+def start_server(app):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Regression check:
+# Compares p95 latency and throughput with a baseline result file.
+# Returns a list of human readable problems.
+def compare(results, baseline, threshold):
+    problems = []
+
+    for driver, scenarios in results["results"].items():
+        for name, now in scenarios.items():
+            before = baseline["results"].get(driver, {}).get(name)
+            if not before:
+                continue
+
+            if before["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + threshold):
+                problems.append(f"{driver}/{name}: p95 {before['p95_ms']} -> {now['p95_ms']} ms")
+            if before["throughput_rps"] and now["throughput_rps"] < before["throughput_rps"] * (1 - threshold):
+                problems.append(f"{driver}/{name}: throughput {before['throughput_rps']} -> {now['throughput_rps']} req/s")
+
+    return problems
+
+
+def latest_result(scale, exclude):
+    paths = sorted(glob.glob(os.path.join(RESULTS_DIR, f"{scale}-*.json")))
+    paths = [p for p in paths if os.path.abspath(p) != os.path.abspath(exclude)]
+    return paths[-1] if paths else None
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_table(title, scenarios):
+    print(f"\n{title}")
+    print(f"  {'endpoint':<20} {'req':>7} {'err':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, s in scenarios.items():
+        print(f"  {name:<20} {s['requests']:>7} {s['errors']:>5} {s['throughput_rps']:>9} "
+              f"{s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Puddings app.")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="Use this database (generated if it doesn't exist).")
+    parser.add_argument("--requests", type=int, default=200, help="Test client requests per endpoint.")
+    parser.add_argument("--duration", type=float, default=5.0, help="HTTP seconds per endpoint.")
+    parser.add_argument("--concurrency", type=int, default=8, help="HTTP client threads.")
+    parser.add_argument("--only", nargs="+", choices=SCENARIOS, help="Only these endpoints.")
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--baseline", help="Result file to compare with (default: previous run).")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown, 0.2 = 20%%.")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    # main.py reads etc/defaults.cfg relative to the project root
+    os.chdir(ROOT)
+    os.environ.setdefault("SECRET_KEY", "bench")
+
+    tmpdir = None
+    path = args.db
+    if not path or not os.path.exists(path):
+        if not path:
+            tmpdir = tempfile.TemporaryDirectory(prefix="puddings-bench-")
+            path = os.path.join(tmpdir.name, "bench.db")
+        print(f"Generating {args.scale} data in {path} ...")
+        started = time.perf_counter()
+        generate(path, args.scale, args.seed)
+        print(f"  done in {time.perf_counter() - started:.1f}s")
+
+    import main as puddings
+    from database import close_pool, get_order_cursor
+
+    app = puddings.app
+    app.config["DATABASE"] = path
+    app.config["DEBUG"] = False
+    app.debug = False
+    close_pool()
+    logging.getLogger("queries").setLevel(logging.ERROR)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    # Delta requests ask for the last 50 order changes
+    def since():
+        with app.app_context():
+            return max(get_order_cursor() - 50, 0)
+
+    names = args.only or list(SCENARIOS)
+    results = {
+        "meta": {
+            "scale": args.scale,
+            "sizes": SCALES[args.scale],
+            "seed": args.seed,
+            "requests": args.requests,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": {"test_client": {}},
+    }
+
+    for name in names:
+        _, path_template, role = SCENARIOS[name]
+        results["results"]["test_client"][name] = run_test_client(
+            app, name, path_template.format(since=since()), role, args.requests)
+    print_table("test_client", results["results"]["test_client"])
+
+    if not args.skip_http:
+        server = start_server(app)
+        results["results"]["http"] = {}
+        for name in names:
+            _, path_template, role = SCENARIOS[name]
+            results["results"]["http"][name] = run_http(
+                app, server.server_port, name, path_template.format(since=since()), role,
+                args.duration, args.concurrency)
+        server.shutdown()
+        print_table(f"http ({args.concurrency} clients)", results["results"]["http"])
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = os.path.join(RESULTS_DIR, f"{args.scale}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved {out}")
+
+    baseline_path = args.baseline or latest_result(args.scale, out)
+    problems = []
+    if baseline_path:
+        with open(baseline_path) as f:
+            problems = compare(results, json.load(f), args.threshold)
+        print(f"Compared with {baseline_path}: {len(problems)} regressions")
+        for problem in problems:
+            print(f"  REGRESSION {problem}")
+
+    if tmpdir:
+        close_pool()
+        tmpdir.cleanup()
+
+    if problems and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
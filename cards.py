@@ -0,0 +1,62 @@
+import json
+import threading
+from flask import render_template
+from markupsafe import Markup
+
+
+# Barista order card cache:
+# An order's customer and items never change after checkout, only its
+# status (which bumps orders.version). So each process keeps the
+# rendered card HTML and the parsed item list per order, keyed by
+# (order id, version). The dashboard, the delta feed and the live
+# stream all take their cards from here, so an unchanged order is a
+# dictionary lookup instead of a JSON parse and a template render.
+#
+# A status change gives the order a new version, which misses the
+# cache in every worker process; the worker that made the change also
+# drops the old entry straight away (forget).
+
+# Most cards kept per process, oldest are dropped first
+MAX_CARDS = 2000
+
+_cards = {}  # order id -> {"version", "items", "html"}
+_lock = threading.Lock()
+
+
+def parse_items(items_json):
+    try:
+        return json.loads(items_json)
+    except (TypeError, ValueError):
+        return []
+
+
+# Returns {"version", "items", "html"} for an order row
+def get_card(o):
+    card = _cards.get(o["id"])
+    if card is not None and card["version"] == o["version"]:
+        return card
+
+    items = parse_items(o["items"])
+    card = {
+        "version": o["version"],
+        "items": items,
+        "html": Markup(render_template("barista/order_card.html", o=o, items=items)),
+    }
+
+    with _lock:
+        _cards.pop(o["id"], None)
+        _cards[o["id"]] = card
+        while len(_cards) > MAX_CARDS:
+            del _cards[next(iter(_cards))]
+
+    return card
+
+
+# Card HTML for each order, by order id (dashboard page)
+def get_cards(orders):
+    return {o["id"]: get_card(o)["html"] for o in orders}
+
+
+def forget(order_id):
+    with _lock:
+        _cards.pop(order_id, None)
@@ -0,0 +1,127 @@
+import json
+import random
+import secrets
+import threading
+import time
+from flask import current_app, session
+from database import get_db
+import queries
+
+
+# Server-side shopping carts:
+# The session cookie only holds an opaque cart id, the cart itself
+# ({menu item id: qty}) lives in a cart store picked by [cart] backend:
+#   sqlite  the carts table, shared by every worker process (default)
+#   memory  a dict in this process, handy for tests and benchmarks
+#
+# Carts untouched for longer than [cart] ttl_hours are treated as empty
+# and swept away, either by `flask --app main sweep-carts` or now and
+# then when a cart is saved (see SWEEP_CHANCE).
+
+# Roughly one save in this many also sweeps abandoned carts
+SWEEP_CHANCE = 200
+
+
+class SQLiteCartStore:
+    def load(self, cart_id, max_age):
+        row = queries.fetch_one(get_db(), "carts.get", (cart_id, time.time() - max_age))
+        return json.loads(row["items"]) if row else {}
+
+    def save(self, cart_id, items):
+        db = get_db()
+        queries.execute(db, "carts.save", (cart_id, json.dumps(items), time.time()))
+        db.commit()
+
+    def delete(self, cart_id):
+        db = get_db()
+        queries.execute(db, "carts.delete", (cart_id,))
+        db.commit()
+
+    def sweep(self, max_age):
+        db = get_db()
+        count = queries.execute(db, "carts.sweep", (time.time() - max_age,)).rowcount
+        db.commit()
+        return count
+
+
+class MemoryCartStore:
+    def __init__(self):
+        self.carts = {}  # cart id -> (items, updated_at)
+        self.lock = threading.Lock()
+
+    def load(self, cart_id, max_age):
+        items, updated_at = self.carts.get(cart_id, ({}, 0))
+        return dict(items) if updated_at >= time.time() - max_age else {}
+
+    def save(self, cart_id, items):
+        with self.lock:
+            self.carts[cart_id] = (dict(items), time.time())
+
+    def delete(self, cart_id):
+        with self.lock:
+            self.carts.pop(cart_id, None)
+
+    def sweep(self, max_age):
+        cutoff = time.time() - max_age
+        with self.lock:
+            expired = [cid for cid, (_, updated_at) in self.carts.items() if updated_at < cutoff]
+            for cart_id in expired:
+                del self.carts[cart_id]
+        return len(expired)
+
+
+BACKENDS = {"sqlite": SQLiteCartStore, "memory": MemoryCartStore}
+_stores = {}
+
+
+def get_store():
+    backend = current_app.config["CART_BACKEND"]
+    if backend not in _stores:
+        _stores[backend] = BACKENDS[backend]()
+    return _stores[backend]
+
+
+def max_age():
+    return current_app.config["CART_TTL_HOURS"] * 3600
+
+
+# The visitor's cart as {menu item id (str): qty}
+def get_cart():
+    # Carts from before the server-side store lived in the cookie
+    if "cart" in session:
+        save_cart(session.pop("cart"))
+
+    cart_id = session.get("cart_id")
+    if not cart_id:
+        return {}
+    return get_store().load(cart_id, max_age())
+
+
+def save_cart(items):
+    if "cart_id" not in session:
+        session["cart_id"] = secrets.token_urlsafe(16)
+
+    store = get_store()
+    store.save(session["cart_id"], items)
+
+    if random.randrange(SWEEP_CHANCE) == 0:
+        store.sweep(max_age())
+
+
+# Adds {item id: qty} to the cart in one write, returns the new cart
+def add_items(quantities):
+    cart = get_cart()
+    for item_id, qty in quantities.items():
+        cart[str(item_id)] = cart.get(str(item_id), 0) + qty
+    save_cart(cart)
+    return cart
+
+
+def clear_cart():
+    cart_id = session.pop("cart_id", None)
+    if cart_id:
+        get_store().delete(cart_id)
+
+
+def sweep():
+    return get_store().sweep(max_age())
@@ -0,0 +1,89 @@
+import threading
+from flask import g
+from database import get_db, get_catalogue_version
+import queries
+
+
+# Menu catalogue cache:
+# The menu changes a few times a day but is read on almost every page,
+# so each process keeps one in-memory copy of menu_items:
+#   items        every item, in id order (admin dashboard)
+#   by_id        item id -> item (cart, checkout, edit form)
+#   by_category  category -> items sorted by name, categories A-Z (menu page)
+#   featured     first two categories with their first three items (home page)
+# Each item also carries its image variants for srcset (see images.py).
+#
+# database.py bumps a "catalogue_version" stamp in the settings table on
+# every menu write. Each request compares it with the cached copy once,
+# so a change made by any worker process shows up everywhere on the
+# next request.
+
+# How many categories / items per category the home page shows
+FEATURED_CATEGORIES = 2
+FEATURED_ITEMS = 3
+
+_catalogue = None
+_lock = threading.Lock()
+
+
+def build(rows, variant_rows, version):
+    # Resized copies of each uploaded image (see images.py)
+    variants = {}
+    for row in variant_rows:
+        variants.setdefault(row["image"], []).append((row["width"], row["format"], row["path"]))
+
+    items = [dict(row) for row in rows]
+    for item in items:
+        item["variants"] = variants.get(item["image"], [])
+
+    by_category = {}
+    for item in sorted(items, key=lambda i: (i["category"], i["name"])):
+        by_category.setdefault(item["category"], []).append(item)
+
+    # Categories in the order they were first added
+    first_seen = {}
+    for item in items:
+        first_seen.setdefault(item["category"], []).append(item)
+
+    featured = {
+        category: category_items[:FEATURED_ITEMS]
+        for category, category_items in list(first_seen.items())[:FEATURED_CATEGORIES]
+    }
+
+    return {
+        "version": version,
+        "items": items,
+        "by_id": {item["id"]: item for item in items},
+        "by_category": by_category,
+        "featured": featured,
+    }
+
+
+# Returns the current catalogue, reloading it if the menu changed
+def get_catalogue():
+    global _catalogue
+
+    # Only look at the version stamp once per request
+    if "catalogue" in g:
+        return g.catalogue
+
+    version = get_catalogue_version()
+    catalogue = _catalogue
+
+    if catalogue is None or catalogue["version"] != version:
+        with _lock:
+            # Another thread may have reloaded it while we waited
+            catalogue = _catalogue
+            if catalogue is None or catalogue["version"] != version:
+                db = get_db()
+                rows = queries.fetch_all(db, "menu.all")
+                variant_rows = queries.fetch_all(db, "images.all_variants")
+                catalogue = build(rows, variant_rows, version)
+                _catalogue = catalogue
+
+    g.catalogue = catalogue
+    return catalogue
+
+
+def get_item(item_id):
+    return get_catalogue()["by_id"].get(item_id)
@@ -1,104 +1,371 @@
+import os
+import re
 import sqlite3
+import threading
+import time
 from flask import g, current_app
 import json
+import events
+import queries
+import rollups
 
 
-# Connect to the database (one connection per request)
+# Connection manager:
+# Opening a fresh connection (and re-running the pragmas) on every
+# request is wasteful, so each process keeps a small pool of open
+# connections per database file. A request borrows one the first time
+# it calls get_db() and hands it back when the app context ends
+# (release_db is registered as a teardown in main.py).
+#
+# Pragmas come from [database] in etc/defaults.cfg. WAL lets the
+# barista board keep reading while checkout writes, and busy_timeout
+# makes writers wait for the lock instead of failing straight away.
+_pools = {}
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+
+def connect(path, pragmas):
+    # check_same_thread is off because pooled connections move between
+    # request threads (only ever one at a time)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.row_factory = sqlite3.Row   # allows dict-like access (row["name"])
+
+    for name, value in pragmas.items():
+        db.execute(f"PRAGMA {name}={value}")
+
+    return db
+
+def acquire_db():
+    global _pool_pid
+    path = current_app.config["DATABASE"]
+
+    with _pool_lock:
+        # After a fork the parent's connections must not be reused
+        if _pool_pid != os.getpid():
+            _pools.clear()
+            _pool_pid = os.getpid()
+
+        pool = _pools.setdefault(path, [])
+        if pool:
+            return pool.pop()
+
+    return connect(path, current_app.config["DB_PRAGMAS"])
+
+def release_db(error=None):
+    db = g.pop("db", None)
+    if db is None:
+        return
+
+    # Never hand back a connection with a half-finished transaction
+    if db.in_transaction:
+        db.rollback()
+
+    with _pool_lock:
+        pool = _pools.get(current_app.config["DATABASE"])
+        if pool is not None and _pool_pid == os.getpid() \
+                and len(pool) < current_app.config["DB_POOL_SIZE"]:
+            pool.append(db)
+            return
+
+    db.close()
+
+# Close every pooled connection (e.g. before forking worker processes)
+def close_pool():
+    with _pool_lock:
+        for pool in _pools.values():
+            for db in pool:
+                db.close()
+        _pools.clear()
+
+# Get this request's database connection
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(current_app.config["DATABASE"])
-        g.db.row_factory = sqlite3.Row   # allows dict-like access (row["name"])
+        g.db = acquire_db()
     return g.db
 
 
+# All SQL below is run by name through the query registry (queries.py).
+
 # Menu items helpers:
 # Handle CRUD operations for menu items.
 # Used heavily by the admin dashboard.
+# Every write bumps the catalogue version so the cached
+# menu (see catalogue.py) reloads in every worker.
 def get_all_items():
-    return get_db().execute("SELECT * FROM menu_items").fetchall()
+    return queries.fetch_all(get_db(), "menu.all")
 
 def get_item(id):
-    return get_db().execute(
-        "SELECT * FROM menu_items WHERE id=?",
-        (id,)
-    ).fetchone()
+    return queries.fetch_one(get_db(), "menu.get", (id,))
 
 def add_item(name, price, category, description, image):
     db = get_db()
-    db.execute("""
-        INSERT INTO menu_items (name, price, category, description, image)
-        VALUES (?, ?, ?, ?, ?)
-    """, (name, price, category, description, image))
+    queries.execute(db, "menu.insert", (name, price, category, description, image))
+    bump_catalogue_version(db)
     db.commit()
 
 def update_item(id, name, price, category, description, image):
     db = get_db()
-    db.execute("""
-        UPDATE menu_items
-        SET name=?, price=?, category=?, description=?, image=?
-        WHERE id=?
-    """, (name, price, category, description, image, id))
+    queries.execute(db, "menu.update", (name, price, category, description, image, id))
+    bump_catalogue_version(db)
     db.commit()
 
 def delete_item(id):
     db = get_db()
-    db.execute("DELETE FROM menu_items WHERE id=?", (id,))
+    queries.execute(db, "menu.delete", (id,))
+    bump_catalogue_version(db)
     db.commit()
 
+# Menu search helpers (admin dashboard):
+# Filtering happens in SQL using the menu_items_fts full-text index
+# and pages are fetched by id (keyset), so nothing loads the whole
+# table no matter how big the catalogue gets.
+
+# Turns what the admin typed into an FTS query: every word must
+# match the start of a word in the name, description or category.
+def fts_query(text):
+    words = re.findall(r"\w+", text or "")
+    return " ".join(f'"{word}"*' for word in words)
+
+# Returns up to `limit` items with an id above after_id
+def search_items(search="", category="", after_id=0, limit=24):
+    return queries.fetch_all(get_db(), "menu.search_page", {
+        "after": after_id,
+        "category": category or "",
+        "search": fts_query(search),
+        "limit": limit,
+    })
+
+def suggest_items(text, limit=10):
+    match = fts_query(text)
+    if not match:
+        return []
+    return queries.fetch_all(get_db(), "menu.suggest", (match, limit))
+
+def get_categories():
+    return [row["category"] for row in queries.fetch_all(get_db(), "menu.categories")]
+
+# Looks up many menu items in one query, returns {id: row}.
+# The ids travel as one JSON array so the SQL stays the same
+# no matter how many items are asked for.
+def get_items_by_ids(ids):
+    rows = queries.fetch_all(get_db(), "menu.get_many", (json.dumps([int(i) for i in ids]),))
+
+    return {row["id"]: row for row in rows}
+
+# Cart pricing:
+# Turns a cart ({item id: qty}) into priced lines and a total in one go.
+# Pass the cached catalogue's id map to skip the database entirely,
+# otherwise every item is fetched with a single query.
+# Items that no longer exist are left out.
+def price_cart(cart, items_by_id=None):
+    if items_by_id is None:
+        items_by_id = get_items_by_ids(cart.keys())
+
+    lines = []
+    total = 0
+
+    for item_id, qty in cart.items():
+        item = items_by_id.get(int(item_id))
+        if item:
+            subtotal = item["price"] * qty
+            total += subtotal
+            lines.append({
+                "id": item["id"],
+                "name": item["name"],
+                "price": item["price"],
+                "qty": qty,
+                "subtotal": subtotal
+            })
+
+    return lines, total
+
+# Catalogue version stamp (kept in the settings table).
+# Bumped inside the caller's transaction, committed with the menu change.
+def bump_catalogue_version(db):
+    queries.execute(db, "settings.bump_catalogue_version")
+
+def get_catalogue_version():
+    row = queries.fetch_one(get_db(), "settings.catalogue_version")
+
+    return int(row["value"]) if row else 0
+
 
 # Order helpers:
-# Create a new order: used by the checkout.
-# Get all orders: used by barista dashboard & analytics.
+# Insert a new order: used by the checkout's ingest writer. Items are
+# dicts with name and qty, plus the menu item id and unit price when known.
+# Get active orders / changes since a cursor: used by the barista dashboard.
 # Update order status: used when barista drags cards.
-def create_order(customer_name, items):
-    db = get_db()
-
+#
+# Every write stamps the order with the next change_seq, so
+# "what changed since X" is a single indexed range query, and
+# updates the analytics rollups in the same transaction.
+# Writes an order and its lines on db without committing, so callers
+# can put several orders in one transaction (see ingest.py).
+# Returns the new order's id.
+def insert_order(db, customer_name, items, idempotency_key=None):
     # Convert the order items list into a JSON string so
     # everything stays structured inside a single column.
-    items_json = json.dumps(items)
+    # (the barista cards only need the name and quantity)
+    items_json = json.dumps([
+        {"name": i["name"], "qty": i["qty"]} for i in items
+    ])
 
-    cursor = db.execute("""
-        INSERT INTO orders (customer_name, items, status)
-        VALUES (?, ?, 'pending')
-    """, (customer_name, items_json))
+    cursor = queries.execute(db, "orders.insert", (customer_name, items_json, idempotency_key))
+    order_id = cursor.lastrowid
 
-    db.commit()
+    # Same transaction: one row per line for analytics
+    queries.execute_many(db, "order_items.insert", [
+        (order_id, i.get("id"), i["name"], i["qty"], i.get("price"))
+        for i in items
+    ])
+
+    rollups.record_order(db, order_id)
+    return order_id
+
+# Id of the order placed with this idempotency key, or None
+def get_order_id_by_key(idempotency_key):
+    row = queries.fetch_one(get_db(), "orders.by_idempotency_key", (idempotency_key,))
+    return row["id"] if row else None
 
-    # return the new order ID (used for receipts)
-    return cursor.lastrowid   
+# An order's lines priced as they were at checkout, shaped like
+# price_cart's result so the receipt can be shown again
+def get_order_lines(order_id):
+    lines = []
+    total = 0.0
+
+    for row in queries.fetch_all(get_db(), "order_items.for_order", (order_id,)):
+        line = dict(row)
+        line["subtotal"] = (line["price"] or 0) * line["qty"]
+        total += line["subtotal"]
+        lines.append(line)
+
+    return lines, total
 
 def get_orders():
     db = get_db()
     # sorted by time so newest appear last in pending
-    return db.execute(
-        "SELECT * FROM orders ORDER BY created_at"
-    ).fetchall()
+    return queries.fetch_all(db, "orders.all")
 
-def update_order_status(order_id, status):
+def get_active_orders():
     db = get_db()
-    db.execute(
-        "UPDATE orders SET status=? WHERE id=?",
-        (status, order_id)
-    )
-    db.commit()
+    # Collected orders are history, the board only needs the rest
+    return queries.fetch_all(db, "orders.active")
+
+def get_orders_changed_since(change_seq, limit=500):
+    db = get_db()
+    return queries.fetch_all(db, "orders.changed_since", (change_seq, limit))
+
+def get_order_cursor():
+    db = get_db()
+    # Highest change_seq handed out so far (0 for an empty table)
+    return queries.fetch_one(db, "orders.cursor")[0]
+
+# Order status state machine:
+# Orders move pending → progress → ready → collected, one step at a
+# time. Stepping back one column is allowed too, to undo a wrong drag.
+STATUS_TRANSITIONS = {
+    "pending": ("progress",),
+    "progress": ("ready", "pending"),
+    "ready": ("collected", "progress"),
+    "collected": ("ready",),
+}
+
+# Applies many status changes in one transaction.
+# changes: [{"order_id", "status", "version"}]. version is the order
+# version the caller last saw; if the order has changed since (someone
+# else moved it) the change is rejected instead of overwriting theirs.
+# Leave version out to skip that check.
+# Returns one result per change: {"order_id", "ok", "error"}, error
+# being None, "missing", "invalid" (not allowed from the current
+# status) or "conflict" (version mismatch).
+def update_order_statuses(changes):
+    db = get_db()
+    results = []
+    changed = []
+
+    # Take the write lock up front so the status and version we read
+    # can't change before our updates land
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for change in changes:
+            order_id = change["order_id"]
+            status = change["status"]
+            version = change.get("version")
+
+            current = queries.fetch_one(db, "orders.status", (order_id,))
+
+            if current is None:
+                error = "missing"
+            elif version is not None and version != current["version"]:
+                error = "conflict"
+            elif status == current["status"]:
+                error = None  # already there, nothing to do
+            elif status not in STATUS_TRANSITIONS.get(current["status"], ()):
+                error = "invalid"
+            else:
+                error = None
+                queries.execute(db, "orders.update_status", (status, order_id, current["version"]))
+                rollups.record_status_change(db, order_id, current["status"], status)
+                changed.append(order_id)
+
+            results.append({"order_id": order_id, "ok": error is None, "error": error})
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for order_id in dict.fromkeys(changed):
+        publish_order(order_id)
+
+    return results
+
+def update_order_status(order_id, status, version=None):
+    return update_order_statuses([
+        {"order_id": order_id, "status": status, "version": version}
+    ])[0]
+
+def get_order(order_id):
+    return queries.fetch_one(get_db(), "orders.get", (order_id,))
+
+# Push the freshly committed order to any open barista streams
+def publish_order(order_id):
+    order = get_order(order_id)
+    if order:
+        events.publish(dict(order))
 
 
 # Settings table:
 # Stores small customisation values such as the active theme.
 # Easy to extend later (dark mode???).
+#
+# The theme is read on every rendered page, so settings are cached:
+# the whole (tiny) table is loaded with one query and kept for
+# SETTINGS_TTL seconds, making lookups plain dictionary reads.
+# set_setting updates this process's copy straight away, other
+# worker processes pick the change up when their copy expires.
+_settings = {"values": {}, "expires": 0}
+
+def load_settings():
+    global _settings
+    rows = queries.fetch_all(get_db(), "settings.all")
+    _settings = {
+        "values": {row["key"]: row["value"] for row in rows},
+        "expires": time.monotonic() + current_app.config["SETTINGS_TTL"],
+    }
+    return _settings
+
 def get_setting(key):
-    db = get_db()
-    row = db.execute(
-        "SELECT value FROM settings WHERE key=?",
-        (key,)
-    ).fetchone()
+    settings = _settings
+    if time.monotonic() >= settings["expires"]:
+        settings = load_settings()
 
-    return row["value"] if row else None
+    return settings["values"].get(key)
 
 def set_setting(key, value):
     db = get_db()
-    db.execute(
-        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
-        (key, value)
-    )
+    queries.execute(db, "settings.set", (key, value))
     db.commit()
+
+    # Write-through so this process sees the new value immediately
+    load_settings()
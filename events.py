@@ -0,0 +1,45 @@
+import queue
+import threading
+
+
+# Order events bus:
+# A tiny in-process publish/subscribe bus used to push order changes
+# to the barista board. Every open stream subscribes with its own queue
+# and database.py publishes the changed order after each commit.
+#
+# This only reaches streams inside the same process. When the app runs
+# with several worker processes, set [events] backend = sqlite so the
+# streams tail the orders table (by change_seq) instead.
+
+# Max events buffered per stream. A stream that falls this far behind
+# gets its backlog replaced by a single None, meaning "resync from
+# the database using your cursor".
+QUEUE_SIZE = 1000
+
+_subscribers = set()
+_lock = threading.Lock()
+
+
+def subscribe():
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    with _lock:
+        _subscribers.add(q)
+    return q
+
+
+def unsubscribe(q):
+    with _lock:
+        _subscribers.discard(q)
+
+
+def publish(event):
+    with _lock:
+        subscribers = list(_subscribers)
+
+    for q in subscribers:
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            with q.mutex:
+                q.queue.clear()
+            q.put_nowait(None)
@@ -0,0 +1,96 @@
+import configparser
+import os
+import signal
+import threading
+import time
+
+
+# Gunicorn settings:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Address, worker processes and threads come from [server] in
+# etc/defaults.cfg (or $PUDDINGS_CONFIG). The app is loaded once in the
+# master and warmed up there (wsgi.py), then forked into the workers.
+#
+# Editing the config file makes the master reload: new workers start
+# with the new settings and old ones finish their requests first.
+# (Same as sending the master a HUP.)
+config_file = os.getenv("PUDDINGS_CONFIG", "etc/defaults.cfg")
+app_config = configparser.ConfigParser()
+app_config.read(config_file)
+
+bind = f"{app_config.get('server', 'host')}:{app_config.getint('server', 'port')}"
+workers = app_config.getint("server", "workers")
+threads = app_config.getint("server", "threads")
+worker_class = "gthread"
+preload_app = True
+
+# Barista boards hold an event stream open, so workers need a thread
+# per open board on top of normal traffic
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# How often the config file is checked for changes, in seconds
+CONFIG_CHECK_INTERVAL = 2
+
+
+# Backends that only work inside one process, and what to use instead
+# when there's more than one worker
+SINGLE_PROCESS = {
+    ("events", "backend", "memory"): ("EVENTS_BACKEND", "sqlite"),
+    ("cart", "backend", "memory"): ("CART_BACKEND", "sqlite"),
+}
+
+
+def shared_overrides(server):
+    if server.cfg.workers < 2:
+        return {}
+    return {
+        key: value
+        for (section, option, single), (key, value) in SINGLE_PROCESS.items()
+        if app_config.get(section, option) == single
+    }
+
+
+def on_starting(server):
+    # The in-process bus and cart store only work within one worker:
+    # barista boards would miss other workers' orders, carts would be
+    # lost between requests
+    for key, value in shared_overrides(server).items():
+        server.log.warning("%s = memory doesn't work with %d workers, using %s",
+                           key, server.cfg.workers, value)
+
+
+def when_ready(server):
+    if not app_config.getboolean("server", "reload_on_config_change"):
+        return
+
+    def watch():
+        mtime = os.stat(config_file).st_mtime
+        while True:
+            time.sleep(CONFIG_CHECK_INTERVAL)
+            try:
+                changed = os.stat(config_file).st_mtime
+            except OSError:
+                continue
+            if changed != mtime:
+                mtime = changed
+                server.log.info("%s changed, reloading workers", config_file)
+                os.kill(os.getpid(), signal.SIGHUP)
+
+    threading.Thread(target=watch, name="config-watch", daemon=True).start()
+
+
+def post_fork(server, worker):
+    from main import app, init
+
+    # The preloaded app has the config from when the master started,
+    # re-read it so a reload picks up the changes
+    init(app)
+    app.config.update(shared_overrides(server))
+
+    # Database connections are per worker: the pool was emptied before
+    # the fork (warm_up) and database.acquire_db starts a fresh one for
+    # this process
+    worker.log.info("Worker %s ready (%d threads)", worker.pid, threads)
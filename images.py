@@ -0,0 +1,114 @@
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, url_for
+from werkzeug.utils import secure_filename
+from database import get_db, bump_catalogue_version
+import queries
+
+# Pillow is optional: without it uploads are still stored and
+# de-duplicated, they just don't get resized variants.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+# Image upload pipeline:
+# Uploaded menu photos are stored under the SHA-256 of their contents
+# (uploads/<hash>.<ext>), so uploading the same photo twice costs nothing.
+# A background thread then makes smaller copies for phones: one per
+# width in VARIANT_WIDTHS, each as WebP and JPEG, and records them in
+# the image_variants table. Templates turn those into srcset attributes
+# (see image_sources below), falling back to the original until the
+# variants exist.
+
+# Thumbnail and menu-card widths, in pixels
+VARIANT_WIDTHS = (320, 640)
+VARIANT_FORMATS = {"webp": ("WEBP", {"quality": 80, "method": 4}),
+                   "jpeg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True})}
+
+CHUNK_SIZE = 64 * 1024
+
+# One worker is plenty: uploads are rare and this keeps CPU use low
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="images")
+
+
+# Saves an uploaded file (werkzeug FileStorage) and returns its
+# path relative to static/, e.g. "uploads/3f2a...c9.jpg"
+def save_upload(image_file):
+    folder = current_app.config["UPLOAD_FOLDER"]
+    ext = os.path.splitext(secure_filename(image_file.filename))[1].lower()
+
+    # Hash while copying to a temp file, so big photos never sit in memory
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".part")
+    with os.fdopen(fd, "wb") as tmp:
+        for chunk in iter(lambda: image_file.stream.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+
+    name = f"{digest.hexdigest()}{ext}"
+    path = os.path.join(folder, name)
+
+    if os.path.exists(path):
+        os.remove(tmp_path)  # same photo uploaded before
+    else:
+        os.replace(tmp_path, path)
+
+    image = f"uploads/{name}"
+
+    if Image is not None and not queries.fetch_one(get_db(), "images.has_variants", (image,)):
+        app = current_app._get_current_object()
+        _executor.submit(make_variants, app, image)
+
+    return image
+
+
+# Background job: build and record the resized copies of one image
+def make_variants(app, image):
+    with app.app_context():
+        static = app.static_folder
+        base, _ = os.path.splitext(image)
+        rows = []
+
+        try:
+            with Image.open(os.path.join(static, image)) as original:
+                original = ImageOps.exif_transpose(original).convert("RGB")
+
+                for width in VARIANT_WIDTHS:
+                    # Never upscaled, the original serves those widths
+                    if width >= original.width:
+                        continue
+
+                    copy = original.copy()
+                    copy.thumbnail((width, width * 10))
+
+                    for fmt, (pil_format, options) in VARIANT_FORMATS.items():
+                        ext = "jpg" if fmt == "jpeg" else fmt
+                        path = f"{base}-{width}.{ext}"
+                        copy.save(os.path.join(static, path), pil_format, **options)
+                        rows.append((image, copy.width, fmt, path))
+        except Exception:
+            app.logger.exception("Could not make variants for %s", image)
+            return
+
+        db = get_db()
+        queries.execute_many(db, "images.insert_variant", rows)
+
+        # Cached menus need to pick up the new srcsets
+        bump_catalogue_version(db)
+        db.commit()
+
+
+# Template helper: srcset strings for an item's image, by format.
+# Returns {} when there are no variants (yet), so templates can
+# just fall back to the plain <img src>.
+def image_sources(item):
+    sources = {}
+    for width, fmt, path in item.get("variants", ()):
+        url = url_for("static", filename=path)
+        sources.setdefault(fmt, []).append(f"{url} {width}w")
+
+    return {fmt: ", ".join(entries) for fmt, entries in sources.items()}
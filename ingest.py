@@ -0,0 +1,116 @@
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from flask import current_app
+from database import get_db, insert_order, publish_order
+import queries
+
+
+# Order ingest queue:
+# Checkout doesn't write the order itself. It hands the priced order to
+# a queue and waits. One writer thread per process takes whatever has
+# piled up (up to [checkout] batch_size orders, waiting batch_wait_ms
+# for more to arrive) and writes the lot in a single transaction, so a
+# rush of checkouts costs one lock and one commit instead of one each.
+# Each checkout's future is resolved with its order id once the batch
+# is committed, so the receipt is only shown for orders that are safely
+# on disk.
+#
+# Every order carries an idempotency key (from the checkout form).
+# If the key was seen before, the existing order's id is returned
+# instead of writing a second order: double-clicks and retries are safe.
+_queue = queue.Queue()
+_writer = {"thread": None, "pid": None}
+_writer_lock = threading.Lock()
+
+
+# Queues an order and returns a Future for its id
+def submit(customer_name, items, idempotency_key):
+    future = Future()
+    _queue.put((customer_name, items, idempotency_key, future))
+    start_writer(current_app._get_current_object())
+    return future
+
+
+# Places an order through the queue and waits for its id
+def place_order(customer_name, items, idempotency_key):
+    future = submit(customer_name, items, idempotency_key)
+    return future.result(timeout=current_app.config["CHECKOUT_TIMEOUT"])
+
+
+def start_writer(app):
+    with _writer_lock:
+        # Threads don't survive a fork, each worker process needs its own
+        if _writer["pid"] == os.getpid() and _writer["thread"].is_alive():
+            return
+
+        thread = threading.Thread(target=run_writer, args=(app,), name="order-writer", daemon=True)
+        thread.start()
+        _writer["thread"] = thread
+        _writer["pid"] = os.getpid()
+
+
+def next_batch(batch_size, wait):
+    batch = [_queue.get()]
+
+    # Give orders arriving at the same moment a chance to join in
+    while len(batch) < batch_size:
+        try:
+            batch.append(_queue.get(timeout=wait))
+        except queue.Empty:
+            break
+
+    return batch
+
+
+def run_writer(app):
+    while True:
+        batch = next_batch(app.config["CHECKOUT_BATCH_SIZE"],
+                           app.config["CHECKOUT_BATCH_WAIT_MS"] / 1000)
+
+        with app.app_context():
+            try:
+                write_batch(batch)
+            except Exception as e:
+                app.logger.exception("Could not write %d orders", len(batch))
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def write_batch(batch):
+    db = get_db()
+    results = []  # (future, order id, is new)
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for customer_name, items, idempotency_key, future in batch:
+            existing = queries.fetch_one(db, "orders.by_idempotency_key", (idempotency_key,))
+            if existing:
+                results.append((future, existing["id"], False))
+                continue
+
+            # A bad order only undoes itself, not the rest of the batch
+            db.execute("SAVEPOINT order_ingest")
+            try:
+                order_id = insert_order(db, customer_name, items, idempotency_key)
+            except sqlite3.Error as e:
+                db.execute("ROLLBACK TO order_ingest")
+                db.execute("RELEASE order_ingest")
+                future.set_exception(e)
+                continue
+
+            db.execute("RELEASE order_ingest")
+            results.append((future, order_id, True))
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for future, order_id, is_new in results:
+        future.set_result(order_id)
+        if is_new:
+            publish_order(order_id)
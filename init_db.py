@@ -1,9 +1,26 @@
 import sqlite3
+import sys
+import json
+import rollups
+import menuio
 from werkzeug.security import generate_password_hash
 
-DB_PATH = "var/cafe.db"
+# Another database file can be given on the command line,
+# e.g. python init_db.py /tmp/bench.db (see bench/)
+DB_PATH = sys.argv[1] if len(sys.argv) > 1 else "var/cafe.db"
+SAMPLE_MENU = "etc/sample_menu.csv"
 connection = sqlite3.connect(DB_PATH)
 
+
+# Adds a column to an existing table if it isn't there yet.
+# Lets databases created by older versions pick up new columns
+# without having to be deleted and recreated.
+def add_column(table, column, definition):
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
 with connection:
 
     # Menu items table:
@@ -20,6 +37,74 @@ with connection:
         )
     """)
 
+    # Categories are listed and filtered on by the admin dashboard
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_menu_items_category
+        ON menu_items(category)
+    """)
+
+    # Bulk imports match rows without an id to items by name
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_menu_items_name
+        ON menu_items(name)
+    """)
+
+    # Menu search index:
+    # Full-text index over name, description and category for the admin
+    # search. It reads its text from menu_items (content=...) and the
+    # triggers below keep it in step with every insert, update and delete.
+    fts_exists = connection.execute("""
+        SELECT 1 FROM sqlite_master WHERE name = 'menu_items_fts'
+    """).fetchone()
+
+    connection.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS menu_items_fts USING fts5(
+            name, description, category,
+            content='menu_items', content_rowid='id'
+        )
+    """)
+
+    connection.execute("""
+        CREATE TRIGGER IF NOT EXISTS menu_items_fts_insert
+        AFTER INSERT ON menu_items BEGIN
+            INSERT INTO menu_items_fts (rowid, name, description, category)
+            VALUES (new.id, new.name, new.description, new.category);
+        END
+    """)
+    connection.execute("""
+        CREATE TRIGGER IF NOT EXISTS menu_items_fts_delete
+        AFTER DELETE ON menu_items BEGIN
+            INSERT INTO menu_items_fts (menu_items_fts, rowid, name, description, category)
+            VALUES ('delete', old.id, old.name, old.description, old.category);
+        END
+    """)
+    connection.execute("""
+        CREATE TRIGGER IF NOT EXISTS menu_items_fts_update
+        AFTER UPDATE ON menu_items BEGIN
+            INSERT INTO menu_items_fts (menu_items_fts, rowid, name, description, category)
+            VALUES ('delete', old.id, old.name, old.description, old.category);
+            INSERT INTO menu_items_fts (rowid, name, description, category)
+            VALUES (new.id, new.name, new.description, new.category);
+        END
+    """)
+
+    # Index any items that existed before the search index did
+    if not fts_exists:
+        connection.execute("INSERT INTO menu_items_fts (menu_items_fts) VALUES ('rebuild')")
+
+    # Image variants table:
+    # Resized copies of uploaded photos (see images.py), used by the
+    # templates to build srcset attributes.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS image_variants (
+            image TEXT NOT NULL,   -- original, e.g. uploads/<hash>.jpg
+            width INTEGER NOT NULL,
+            format TEXT NOT NULL,  -- webp / jpeg
+            path TEXT NOT NULL,
+            PRIMARY KEY (image, width, format)
+        )
+    """)
+
     # Users table:
     # Stores admin + barista accounts.
     # Passwords are hashed for security.
@@ -37,15 +122,220 @@ with connection:
     # Stores every order created when a customer checks out.
     # Status is used by the barista dashboard (pending → progress → ready → collected).
     # created_at is for analytics + timestamps.
+    # change_seq goes up every time an order is written so the barista
+    # board can fetch only the orders that changed since its last look.
     connection.execute("""
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             customer_name TEXT,
             items TEXT NOT NULL,  -- stored as JSON string
             status TEXT NOT NULL CHECK(status IN ('pending', 'progress', 'ready', 'collected')),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            change_seq INTEGER NOT NULL DEFAULT 0,
+            idempotency_key TEXT,  -- sent with the checkout form, stops double orders
+            version INTEGER NOT NULL DEFAULT 1  -- +1 on every status change
+        )
+    """)
+
+    # Older databases: add change_seq and give existing orders a starting value
+    add_column("orders", "change_seq", "INTEGER NOT NULL DEFAULT 0")
+    connection.execute("UPDATE orders SET change_seq = id WHERE change_seq = 0")
+
+    add_column("orders", "idempotency_key", "TEXT")
+    add_column("orders", "version", "INTEGER NOT NULL DEFAULT 1")
+
+    # One order per checkout, however many times the form is submitted
+    connection.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key
+        ON orders(idempotency_key)
+    """)
+
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_change_seq
+        ON orders(change_seq)
+    """)
+
+    # Board queries filter on status, analytics group on created_at
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_status_created
+        ON orders(status, created_at)
+    """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_created
+        ON orders(created_at)
+    """)
+
+    # Order items table:
+    # One row per line of an order, written together with the order.
+    # orders.items keeps the JSON copy for the barista cards, this table
+    # is what analytics reads so it never has to parse JSON.
+    # menu_item_id keeps an item's identity even if it gets renamed later.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL REFERENCES orders(id),
+            menu_item_id INTEGER,  -- NULL if the item couldn't be matched
+            name TEXT NOT NULL,    -- name at the time of ordering
+            qty INTEGER NOT NULL,
+            unit_price REAL
         )
     """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_items_order
+        ON order_items(order_id)
+    """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_items_menu_item
+        ON order_items(menu_item_id)
+    """)
+
+    # Order archive (see archive.py):
+    # Collected orders older than [archive] after_days are moved here
+    # (with their lines) so the orders table only holds the recent,
+    # busy part of the history. Same columns as the live tables.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS orders_archive (
+            id INTEGER PRIMARY KEY,
+            customer_name TEXT,
+            items TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP,
+            change_seq INTEGER NOT NULL,
+            idempotency_key TEXT,
+            version INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+    add_column("orders_archive", "version", "INTEGER NOT NULL DEFAULT 1")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS order_items_archive (
+            id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            menu_item_id INTEGER,
+            name TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            unit_price REAL
+        )
+    """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_items_archive_order
+        ON order_items_archive(order_id)
+    """)
+
+    # Live + archived, for the few readers that need the whole
+    # history (rollup rebuilds, order exports)
+    connection.execute("""
+        CREATE VIEW IF NOT EXISTS all_orders AS
+        SELECT id, customer_name, items, status, created_at, change_seq FROM orders
+        UNION ALL
+        SELECT id, customer_name, items, status, created_at, change_seq FROM orders_archive
+    """)
+    connection.execute("""
+        CREATE VIEW IF NOT EXISTS all_order_items AS
+        SELECT id, order_id, menu_item_id, name, qty, unit_price FROM order_items
+        UNION ALL
+        SELECT id, order_id, menu_item_id, name, qty, unit_price FROM order_items_archive
+    """)
+
+    # Analytics rollups (see rollups.py):
+    # Orders, collected orders and revenue per hour/day bucket, plus
+    # how often each item was ordered per bucket. Kept up to date by
+    # database.py so the analytics page never scans the orders table.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS order_rollups (
+            grain TEXT NOT NULL CHECK(grain IN ('hour', 'day')),
+            bucket TEXT NOT NULL,  -- 'YYYY-MM-DD HH:00' or 'YYYY-MM-DD'
+            orders INTEGER NOT NULL DEFAULT 0,
+            collected INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (grain, bucket)
+        )
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS item_rollups (
+            grain TEXT NOT NULL CHECK(grain IN ('hour', 'day')),
+            bucket TEXT NOT NULL,
+            item_key TEXT NOT NULL,  -- menu item id, or 'name:<name>' if unmatched
+            menu_item_id INTEGER,
+            name TEXT NOT NULL,
+            lines INTEGER NOT NULL DEFAULT 0,  -- how many orders had it
+            qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (grain, bucket, item_key)
+        )
+    """)
+
+    # Order transitions (see rollups.py):
+    # Append-only log of every status an order enters, with when. Orders
+    # start with a row from NULL to 'pending'. Never updated or deleted
+    # (archiving an order leaves its transitions), so the timing rollups
+    # below can always be rebuilt from it.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS order_transitions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_order_transitions_order
+        ON order_transitions(order_id, id)
+    """)
+
+    # Timing rollups:
+    # stage_rollups is a histogram of how long orders spent in each
+    # status (slot = bucket in queries.STAGE_BOUNDS), per hour/day the
+    # stage ended. flow_rollups counts orders entering and leaving each
+    # status per hour/day; their running total is the queue depth.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS stage_rollups (
+            grain TEXT NOT NULL CHECK(grain IN ('hour', 'day')),
+            bucket TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            seconds REAL NOT NULL DEFAULT 0,  -- total time, for the mean
+            PRIMARY KEY (grain, bucket, stage, slot)
+        )
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS flow_rollups (
+            grain TEXT NOT NULL CHECK(grain IN ('hour', 'day')),
+            bucket TEXT NOT NULL,
+            status TEXT NOT NULL,
+            entered INTEGER NOT NULL DEFAULT 0,
+            left_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (grain, bucket, status)
+        )
+    """)
+
+    # Rate limits table:
+    # One token bucket per login IP / username (see ratelimit.py),
+    # shared by every worker process.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,    -- e.g. 'ip:1.2.3.4' or 'user:testadmin'
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,  -- unix time of the last attempt
+            allowed INTEGER NOT NULL   -- whether the last attempt got a token
+        )
+    """)
+
+    # Carts table:
+    # Shopping carts kept on the server (see carts.py), the visitor's
+    # cookie only holds the id. items is a small JSON {item id: qty}.
+    # updated_at (unix time) is what expired carts are swept by.
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS carts (
+            id TEXT PRIMARY KEY,
+            items TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS idx_carts_updated
+        ON carts(updated_at)
+    """)
 
     # Settings table
     # Used to store things like the active theme (default, Halloween, future: Christmas…)
@@ -80,37 +370,60 @@ with connection:
 
     # Insert sample menu items:
     # These are placeholders so the site has content immediately.
-    # Admin can change/remove everything later.
+    # Admin can change/remove everything later (or import a whole
+    # menu from /admin/import). Loaded with the bulk importer.
     item_count = connection.execute("SELECT COUNT(*) FROM menu_items").fetchone()[0]
 
     if item_count == 0:
+        with open(SAMPLE_MENU, newline="", encoding="utf-8") as f:
+            menuio.load_menu(connection, menuio.read_rows(f, "csv"))
+
+        print("Added sample menu items.")
+
+    # Backfill order_items:
+    # Orders placed before order_items existed only have the JSON copy.
+    # Split those into rows, matching items to the menu by name.
+    menu = {
+        row[0]: (row[1], row[2])
+        for row in connection.execute("SELECT name, id, price FROM menu_items")
+    }
+
+    missing = connection.execute("""
+        SELECT id, items FROM orders
+        WHERE id NOT IN (SELECT order_id FROM order_items)
+    """).fetchall()
+
+    for order_id, items_json in missing:
+        rows = []
+        for item in json.loads(items_json):
+            menu_item_id, price = menu.get(item["name"], (None, None))
+            rows.append((order_id, menu_item_id, item["name"], item["qty"], price))
+
         connection.executemany("""
-            INSERT INTO menu_items (name, price, category, description, image)
+            INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price)
             VALUES (?, ?, ?, ?, ?)
-        """, [
+        """, rows)
 
-            # Drinks
-            ("Vanilla Latte", 3.80, "Drinks", "Smooth espresso blended with steamed milk and vanilla syrup.", "img/slideshow4.png"),
-            ("Iced Caramel Macchiato", 4.20, "Drinks", "Espresso over milk with sweet caramel drizzle served on ice.", "img/slideshow5.png"),
-            ("Mocha Deluxe", 4.50, "Drinks", "Rich espresso mixed with chocolate and topped with whipped cream.", "img/slideshow4.png"),
-            ("Matcha Green Tea Latte", 4.00, "Drinks", "Creamy ceremonial-grade matcha blended with milk.", "img/slideshow5.png"),
-            ("Chai Spice Latte", 3.90, "Drinks", "Aromatic chai infused with cinnamon, cardamom, and warm spices.", "img/slideshow4.png"),
-
-            # Cake
-            ("Triple Chocolate Cake Slice", 4.50, "Cake", "Dark, milk, and white chocolate layers topped with ganache.", "img/slideshow2.png"),
-            ("Victoria Sponge Slice", 4.20, "Cake", "Classic vanilla sponge filled with raspberry jam and cream.", "img/slideshow3.png"),
-            ("Carrot Walnut Cake", 4.30, "Cake", "Moist carrot cake with walnuts and cream cheese frosting.", "img/slideshow2.png"),
-            ("Red Velvet Slice", 4.40, "Cake", "Smooth cocoa sponge with velvety cream cheese icing.", "img/slideshow3.png"),
-            ("Lemon Drizzle Slice", 3.90, "Cake", "Zesty lemon sponge soaked in sweet citrus glaze.", "img/slideshow3.png"),
-
-            # Board games
-            ("Uno Deck", 1.50, "Board Games", "Fast-paced card game fun for all ages.", "img/shess.png"),
-            ("Jenga Tower", 2.00, "Board Games", "Stack wooden blocks and try not to let the tower fall!", "img/shess.png"),
-            ("Chess Set", 2.50, "Board Games", "Classic strategy board game for two players.", "img/shess.png"),
-            ("Dobble", 1.80, "Board Games", "Find and match symbols quickly before your opponents!", "img/shess.png"),
-            ("Exploding Kittens", 2.20, "Board Games", "Chaotic and fun card game filled with surprises.", "img/shess.png")
-        ])
+    if missing:
+        print(f"Backfilled order_items for {len(missing)} orders.")
 
-        print("Added sample menu items.")
+    # Backfill order_transitions:
+    # Orders from before the log get one row into their current status
+    # at created_at. That keeps the queue depth right, there's just no
+    # stage timing for them.
+    untimed = connection.execute("""
+        INSERT INTO order_transitions (order_id, from_status, to_status, at)
+        SELECT id, NULL, status, created_at FROM all_orders
+        WHERE id NOT IN (SELECT order_id FROM order_transitions)
+        ORDER BY id
+    """).rowcount
+
+    # Fill the rollups for databases that had orders before them
+    rollup_count = connection.execute("SELECT COUNT(*) FROM order_rollups").fetchone()[0]
+    order_count = connection.execute("SELECT COUNT(*) FROM all_orders").fetchone()[0]
+
+    if (rollup_count == 0 or untimed) and order_count > 0:
+        rollups.rebuild(connection)
+        print("Built analytics rollups.")
 
 print("Database initialised!")
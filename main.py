@@ -1,17 +1,38 @@
-from flask import Flask, render_template, g, request, session, redirect
-import sqlite3
+from flask import Flask, abort, render_template, request, redirect, jsonify, session
 import configparser
-from database import create_order
+from database import (
+    get_order_id_by_key, get_order_lines, price_cart, release_db, close_pool, load_settings
+)
 import json
 from auth import auth 
 from admin import admin
 from barista import barista
+from metrics import metrics
+import metrics as request_metrics
+from images import image_sources
+from assets import assets, asset_url, build_manifest
+from pagecache import cached_page
 from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache
 import os
+import logging
+import click
+import rollups
+import catalogue
+import carts
+import ingest
+import menuio
+import archive
+import queries
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeout
 
 load_dotenv()
 app = Flask(__name__)
 
+# Most of one item a single bulk cart request may add
+MAX_ADD_QTY = 20
+
 @app.template_filter("loads")
 def loads_filter(s):
     try:
@@ -20,14 +41,31 @@ def loads_filter(s):
         return []
 
 
+# Responsive image sources (srcset) for menu items, see images.py
+app.add_template_global(image_sources)
+
+# Fingerprinted, long-cached URLs for static files, see assets.py
+app.add_template_global(asset_url)
+
+
+# Reads etc/defaults.cfg (or the file in $PUDDINGS_CONFIG) into app.config.
+# Called at import, and again in every new server worker so config
+# changes are picked up on reload (see gunicorn.conf.py).
 def init(app):
     config = configparser.ConfigParser()
-    config_location = "etc/defaults.cfg"
+    config_location = os.getenv("PUDDINGS_CONFIG", "etc/defaults.cfg")
 
     try:
-        print("Loading config:", config_location)
         config.read(config_location)
 
+        # Logging
+        logging.basicConfig(
+            level=config.get("logging", "level"),
+            format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s"
+        )
+        app.logger.info("Loading config: %s", config_location)
+        app.config["CONFIG_FILE"] = config_location
+
         # Flask config
         app.config["DEBUG"] = config.getboolean("flask", "debug")
         app.secret_key = os.getenv("SECRET_KEY")
@@ -35,16 +73,71 @@ def init(app):
         # Server config
         app.config["HOST"] = config.get("server", "host")
         app.config["PORT"] = config.getint("server", "port")
+        app.config["WORKERS"] = config.getint("server", "workers")
+        app.config["THREADS"] = config.getint("server", "threads")
+        app.config["RELOAD_ON_CONFIG_CHANGE"] = config.getboolean("server", "reload_on_config_change")
+
+        # Templates: auto-reload on, off or (None) the same as debug,
+        # set on the environment too as it already exists when a worker
+        # re-reads the config. Then the on-disk cache of compiled templates.
+        auto_reload = None
+        if config.get("templates", "auto_reload"):
+            auto_reload = config.getboolean("templates", "auto_reload")
+        app.config["TEMPLATES_AUTO_RELOAD"] = auto_reload
+        app.jinja_env.auto_reload = app.config["DEBUG"] if auto_reload is None else auto_reload
+
+        bytecode_cache = config.get("templates", "bytecode_cache")
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache)
+        else:
+            app.jinja_env.bytecode_cache = None
 
         # Database config
         app.config["DATABASE"] = config.get("database", "db_path")
+        app.config["DB_POOL_SIZE"] = config.getint("database", "pool_size")
+        app.config["DB_PRAGMAS"] = {
+            name: config.get("database", name)
+            for name in ("journal_mode", "synchronous", "busy_timeout", "mmap_size", "cache_size")
+        }
+        app.config["SETTINGS_TTL"] = config.getfloat("settings", "cache_ttl")
+        app.config["SLOW_QUERY_MS"] = config.getfloat("metrics", "slow_query_ms")
 
         # Upload folder for admin image uploads
         app.config["UPLOAD_FOLDER"] = "static/uploads"
         os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
-    except Exception as e:
-        print("Error reading config:", e)
+        # Barista live updates (see events.py)
+        app.config["EVENTS_BACKEND"] = config.get("events", "backend")
+        app.config["EVENTS_POLL_INTERVAL"] = config.getfloat("events", "poll_interval")
+        app.config["EVENTS_KEEPALIVE"] = config.getfloat("events", "keepalive")
+
+        # Server-side carts (see carts.py)
+        app.config["CART_BACKEND"] = config.get("cart", "backend")
+        app.config["CART_TTL_HOURS"] = config.getfloat("cart", "ttl_hours")
+
+        # Login protection (see ratelimit.py and passwords.py)
+        app.config["LOGIN_IP_BURST"] = config.getint("login", "ip_burst")
+        app.config["LOGIN_IP_PER_MINUTE"] = config.getfloat("login", "ip_per_minute")
+        app.config["LOGIN_USER_BURST"] = config.getint("login", "user_burst")
+        app.config["LOGIN_USER_PER_MINUTE"] = config.getfloat("login", "user_per_minute")
+        app.config["LOGIN_HASH_METHOD"] = config.get("login", "hash_method")
+        app.config["LOGIN_HASH_WORKERS"] = config.getint("login", "hash_workers")
+        app.config["LOGIN_HASH_QUEUE"] = config.getint("login", "hash_queue")
+        app.config["LOGIN_HASH_WAIT"] = config.getfloat("login", "hash_wait")
+
+        # Order archival (see archive.py)
+        app.config["ARCHIVE_AFTER_DAYS"] = config.getfloat("archive", "after_days")
+        app.config["ARCHIVE_BATCH_SIZE"] = config.getint("archive", "batch_size")
+        app.config["ARCHIVE_PAUSE_MS"] = config.getfloat("archive", "pause_ms")
+
+        # Order ingest queue (see ingest.py)
+        app.config["CHECKOUT_BATCH_SIZE"] = config.getint("checkout", "batch_size")
+        app.config["CHECKOUT_BATCH_WAIT_MS"] = config.getfloat("checkout", "batch_wait_ms")
+        app.config["CHECKOUT_TIMEOUT"] = config.getfloat("checkout", "timeout")
+
+    except Exception:
+        app.logger.exception("Error reading config")
 
 init(app)
 
@@ -52,49 +145,26 @@ init(app)
 app.register_blueprint(auth)
 app.register_blueprint(admin)
 app.register_blueprint(barista)
+app.register_blueprint(metrics)
+app.register_blueprint(assets)
 
-# Database
-def get_db():
-    if "db" not in g:
-        g.db = sqlite3.connect(app.config["DATABASE"])
-        g.db.row_factory = sqlite3.Row
-    return g.db
-
+# Hash the static files once, before the first request
+build_manifest(app)
 
-@app.teardown_appcontext
-def close_db(error=None):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
+# Database
+# Connections come from the pool in database.py and go back to it
+# once the request (or any other app context) is finished.
+app.teardown_appcontext(release_db)
 
 
 # Main routes
+# Menu data comes from the in-memory catalogue (see catalogue.py),
+# and the storefront pages are served from the page cache (pagecache.py)
 @app.route("/")
+@cached_page
 def home():
-    db = get_db()
-
-    # Fetch categories
-    categories = db.execute("""
-        SELECT DISTINCT category FROM menu_items
-    """).fetchall()
-
-    # Convert rows to list of strings
-    categories = [c["category"] for c in categories]
-
-    # Pick the first categories to display
-    featured = categories[:2]
-
-    # Load items for these two categories
-    featured_data = {}
-    for cat in featured:
-        items = db.execute("""
-            SELECT id, name, price, image
-            FROM menu_items
-            WHERE category = ?
-            LIMIT 3
-        """, (cat,)).fetchall()
-
-        featured_data[cat] = items
+    # First categories with a few items each, precomputed by the catalogue
+    featured_data = catalogue.get_catalogue()["featured"]
 
     return render_template("home.html", 
                            active="home", 
@@ -103,89 +173,118 @@ def home():
 
 # About page 
 @app.route("/about")
+@cached_page
 def about():
     return render_template("about.html", active="about")
 
 # Menu (ordering) Page
+# (the cart counter is filled in by JavaScript from /cart/count so
+# the page itself is the same for everyone and can be cached)
 @app.route("/menu")
+@cached_page
 def menu():
-    db = get_db()
-    items = db.execute("""
-        SELECT id, name, price, category, description, image
-        FROM menu_items
-        ORDER BY category, name
-    """).fetchall()
+    # Items grouped by category, already sorted by category and name
+    categories = catalogue.get_catalogue()["by_category"]
 
-    categories = {}
-    for item in items:
-        categories.setdefault(item["category"], []).append(item)
-    cart = session.get("cart", {})
-    cart_count = sum(cart.values())
+    return render_template("menu.html", categories=categories,
+                           max_add_qty=MAX_ADD_QTY, active="menu")
 
-    return render_template("menu.html", categories=categories, active="menu", cart_count=cart_count)
+# Number of items in the visitor's cart (AJAX, used by the menu page)
+@app.route("/cart/count")
+def cart_count():
+    cart = carts.get_cart()
+    return jsonify({"count": sum(cart.values())})
 
 # Cart page 
+# (the cart itself is stored server-side, see carts.py)
 @app.route("/cart")
 def cart():
-    db = get_db()
-    cart = session.get("cart", {})
+    cart = carts.get_cart()
 
-    items = []
+    # Whole cart priced in one go from the cached catalogue
+    items, total = price_cart(cart, catalogue.get_catalogue()["by_id"])
 
-    for item_id, qty in cart.items():
-        item = db.execute("SELECT * FROM menu_items WHERE id=?", (item_id,)).fetchone()
-        if item:
-            items.append({"item": item, "qty": qty})
+    # Sent back with the checkout form so submitting it twice
+    # still only places one order (see ingest.py)
+    checkout_key = uuid.uuid4().hex
 
-    return render_template("cart.html", items=items, active="cart")
+    return render_template("cart.html", items=items, total=total,
+                           checkout_key=checkout_key, active="cart")
 
 
 @app.route("/add-to-cart/<int:item_id>", methods=["POST"])
 def add_to_cart(item_id):
-    cart = session.get("cart", {})
+    # Only items checkout can actually price
+    if catalogue.get_item(item_id) is None:
+        abort(404)
 
-    qty = int(request.form.get("quantity", 1))
-    item_id = str(item_id)
+    try:
+        qty = int(request.form.get("quantity", 1))
+    except ValueError:
+        abort(400)
+    if qty < 1:
+        abort(400)
+
+    # Same cap as the bulk endpoint
+    carts.add_items({item_id: min(qty, MAX_ADD_QTY)})
+    return redirect("/menu")
 
-    cart[item_id] = cart.get(item_id, 0) + qty
+# Add several items in one request (AJAX, the menu page batches
+# Add clicks into this). Body: {"items": {"<item id>": qty, ...}}
+# Quantities above MAX_ADD_QTY are cut down to it, the returned count
+# is what the cart really holds.
+@app.route("/cart/add-many", methods=["POST"])
+def add_many_to_cart():
+    data = request.get_json(silent=True) or {}
+    menu_items = catalogue.get_catalogue()["by_id"]
 
-    session["cart"] = cart # Resets every session 
-    return redirect("/menu")
+    quantities = {}
+    try:
+        for item_id, qty in data.get("items", {}).items():
+            qty = int(qty)
+            if int(item_id) in menu_items and qty > 0:
+                quantities[str(int(item_id))] = min(qty, MAX_ADD_QTY)
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"error": "items must map item ids to quantities"}), 400
+
+    cart = carts.add_items(quantities) if quantities else carts.get_cart()
+    return jsonify({"count": sum(cart.values())})
 
 # Checkout page
+# The order is written by the ingest queue's writer thread together
+# with any other checkouts arriving at the same time (see ingest.py);
+# the receipt is shown once it has been committed.
 @app.route("/checkout", methods=["POST"])
 def checkout():
-    cart = session.get("cart", {})
+    cart = carts.get_cart()
 
-    if not cart:
-        return redirect("/cart")
+    # Without a key from the form, one order per cart
+    key = request.form.get("checkout_key") or f"cart:{session.get('cart_id')}"
 
-    db = get_db()
+    # Submitted again (double-click, retry): show the same receipt
+    order_id = get_order_id_by_key(key)
+    if order_id is not None:
+        order_items, total = get_order_lines(order_id)
+        return render_receipt(order_id, order_items, total)
 
-    order_items = []
-    total = 0
+    if not cart:
+        return redirect("/cart")
 
-    for item_id, qty in cart.items():
-        item = db.execute(
-            "SELECT * FROM menu_items WHERE id=?", (item_id,)
-        ).fetchone()
+    # Price every line at once (no per-item lookups)
+    order_items, total = price_cart(cart, catalogue.get_catalogue()["by_id"])
 
-        if item:
-            subtotal = item["price"] * qty
-            total += subtotal
-            order_items.append({
-                "name": item["name"],
-                "qty": qty,
-                "subtotal": subtotal
-            })
+    # Queue the order and wait for its ID
+    try:
+        order_id = ingest.place_order("Customer", order_items, key)
+    except FutureTimeout:
+        # Still queued; resubmitting with the same key is safe
+        abort(503)
 
-    # Create the order and GET the ID
-    order_id = create_order("Customer", [
-        {"name": i["name"], "qty": i["qty"]} for i in order_items
-    ])
+    carts.clear_cart()
 
-    session["cart"] = {}
+    return render_receipt(order_id, order_items, total)
 
+def render_receipt(order_id, order_items, total):
     from datetime import datetime
     now = datetime.now().strftime("%d %b %Y • %H:%M")
 
@@ -198,18 +297,126 @@ def checkout():
     )
 
 # Admin change theme getter
+# (served from the settings cache, no query per page)
 @app.context_processor
 def inject_theme():
     from database import get_setting
     theme = get_setting("theme")
     return {"active_theme": theme}
 
+# Rebuild analytics rollups (CLI):
+#   flask --app main rebuild-rollups          recompute from raw orders
+#   flask --app main rebuild-rollups --check  only report differences
+@app.cli.command("rebuild-rollups")
+@click.option("--check", is_flag=True, help="Only compare, don't rebuild.")
+def rebuild_rollups_command(check):
+    from database import get_db
+    db = get_db()
+
+    problems = rollups.check(db)
+    for table, key in problems:
+        click.echo(f"Mismatch in {table}: {key}")
+    click.echo(f"{len(problems)} rollup rows out of date.")
+
+    if not check:
+        rollups.rebuild(db)
+        click.echo("Rollups rebuilt.")
+
+# Move old collected orders to the archive tables (CLI), e.g. nightly:
+#   flask --app main archive-orders
+#   flask --app main archive-orders --days 90
+@app.cli.command("archive-orders")
+@click.option("--days", type=float, help="Archive collected orders older than this (default from config).")
+def archive_orders_command(days):
+    from database import get_db
+
+    moved = archive.archive_orders(
+        get_db(),
+        days if days is not None else app.config["ARCHIVE_AFTER_DAYS"],
+        app.config["ARCHIVE_BATCH_SIZE"],
+        app.config["ARCHIVE_PAUSE_MS"] / 1000
+    )
+    click.echo(f"Archived {moved} orders.")
+
+# Bulk menu import / export (CLI), see menuio.py:
+#   flask --app main import-menu seasonal.csv
+#   flask --app main export-menu menu.jsonl
+#   flask --app main export-orders orders.csv --start 2025-01-01
+# "-" reads from stdin / writes to stdout.
+@app.cli.command("import-menu")
+@click.argument("file", type=click.File("r", encoding="utf-8-sig"))
+@click.option("--format", "fmt", type=click.Choice(menuio.FORMATS), help="Default: from the file name.")
+def import_menu_command(file, fmt):
+    report = menuio.import_menu(file, menuio.guess_format(fmt, file.name))
+
+    for error in report["errors"]:
+        click.echo(f"Line {error['line']}: {error['error']}", err=True)
+    click.echo(f"{report['imported']} items imported, {report['error_count']} rows skipped.")
+
+@app.cli.command("export-menu")
+@click.argument("file", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--format", "fmt", type=click.Choice(menuio.FORMATS), help="Default: from the file name.")
+def export_menu_command(file, fmt):
+    for chunk in menuio.export_menu(menuio.guess_format(fmt, file.name)):
+        file.write(chunk)
+
+@app.cli.command("export-orders")
+@click.argument("file", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--format", "fmt", type=click.Choice(menuio.FORMATS), help="Default: from the file name.")
+@click.option("--start", default="0000-00-00", help="First day, YYYY-MM-DD.")
+@click.option("--end", default="9999-99-99", help="Day after the last, YYYY-MM-DD.")
+def export_orders_command(file, fmt, start, end):
+    for chunk in menuio.export_orders(menuio.guess_format(fmt, file.name), start, end):
+        file.write(chunk)
+
+# Drop abandoned carts (CLI), e.g. from a daily cron job:
+#   flask --app main sweep-carts
+@app.cli.command("sweep-carts")
+def sweep_carts_command():
+    click.echo(f"Removed {carts.sweep()} expired carts.")
+
 # Access forbidden page (designed 403 template)
 @app.errorhandler(403)
 def forbidden(e):
     return render_template("errors/403.html"), 403
 
+# Warm-up (see wsgi.py):
+# Builds everything the first requests would otherwise pay for: the
+# settings and menu caches, every compiled template and the cached
+# storefront pages. With a preloaded app this runs once, in the server's
+# master process, and the forked workers start with it all in memory.
+def warm_up(app):
+    with app.app_context():
+        load_settings()
+        catalogue.get_catalogue()
+
+        compiled = compile_templates(app)
+
+    client = app.test_client()
+    for path in ("/", "/about", "/menu"):
+        client.get(path)
+
+    # Don't count the warm-up as traffic
+    request_metrics.reset()
+    queries.reset_stats()
+
+    # Connections must not cross a fork, workers open their own
+    close_pool()
+
+    app.logger.info("Warm-up done: %d templates compiled", compiled)
+
+
+# Compiles every template up front, so no request pays for it.
+# With [templates] bytecode_cache set, templates already compiled by an
+# earlier process are loaded from there instead of compiled again.
+def compile_templates(app):
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
 if __name__ == "__main__":
+    compile_templates(app)
     app.run(
         host=app.config["HOST"],
         port=app.config["PORT"],
@@ -0,0 +1,211 @@
+import csv
+import io
+import json
+import math
+from database import get_db, bump_catalogue_version
+import queries
+
+
+# Bulk menu import / export:
+# Menus come in and go out as CSV or JSON Lines (one object per line),
+# row by row, so a catalogue of any size never has to fit in memory.
+#
+# Importing validates every row and upserts the good ones in chunks of
+# CHUNK_SIZE with executemany, one transaction per chunk (if the file
+# turns out to be broken half way, the chunks before stay imported).
+# Rows with an id update that item (or create it with that id), rows
+# without one update the item with the same name, or add a new item.
+# Bad rows are skipped and reported with their line number.
+#
+# Used by the admin import/export pages (admin.py), the import-menu /
+# export-menu / export-orders CLI commands (main.py) and init_db.py for
+# the sample menu.
+
+MENU_FIELDS = ("id", "name", "price", "category", "description", "image")
+ORDER_FIELDS = ("order_id", "created_at", "status", "customer_name",
+                "menu_item_id", "name", "qty", "unit_price")
+FORMATS = ("csv", "jsonl")
+
+CHUNK_SIZE = 500
+# Only the first few errors are kept, the rest are just counted
+MAX_ERRORS = 100
+
+
+# Picks csv / jsonl from an explicit choice or a file name
+def guess_format(fmt=None, filename=""):
+    if fmt in FORMATS:
+        return fmt
+    if filename.lower().endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    return "csv"
+
+
+# Yields (line number, row dict or error message) from a text stream
+def read_rows(stream, fmt):
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, "not valid JSON"
+            continue
+        yield line_num, row if isinstance(row, dict) else "expected a JSON object"
+
+
+# Checks one row, returns (id or None, values) or raises ValueError
+def validate(row):
+    def text(field):
+        value = row.get(field)
+        return "" if value is None else str(value).strip()
+
+    name = text("name")
+    category = text("category")
+    if not name:
+        raise ValueError("name is required")
+    if not category:
+        raise ValueError("category is required")
+
+    try:
+        price = round(float(text("price")), 2)
+    except ValueError:
+        raise ValueError(f"price {text('price')!r} is not a number")
+    if not math.isfinite(price):
+        raise ValueError(f"price {text('price')!r} is not a number")
+    if price < 0:
+        raise ValueError("price can't be negative")
+
+    image = text("image") or None
+    if image and (image.startswith("/") or ".." in image):
+        raise ValueError("image must be a path under static/")
+
+    item_id = None
+    if text("id"):
+        try:
+            item_id = int(text("id"))
+        except ValueError:
+            raise ValueError(f"id {text('id')!r} is not a whole number")
+
+    return item_id, (name, price, category, text("description"), image)
+
+
+def write_chunk(db, by_id, by_name):
+    if by_id:
+        queries.execute_many(db, "menu.upsert", by_id)
+    if by_name:
+        # Insert first, so a name repeated in the file updates the new item
+        queries.execute_many(db, "menu.insert_if_new", [values + values[:1] for values in by_name])
+        queries.execute_many(db, "menu.update_by_name", [values[1:] + values[:1] for values in by_name])
+
+
+# Validates rows ((line, row) pairs from read_rows) and yields the good
+# ones CHUNK_SIZE at a time as (by_id, by_name) lists, for write_chunk.
+# Bad rows go in report, the caller counts the imported ones.
+def valid_chunks(rows, report):
+    by_id, by_name = [], []
+
+    for line_num, row in rows:
+        try:
+            if isinstance(row, str):
+                raise ValueError(row)
+            item_id, values = validate(row)
+        except ValueError as e:
+            report["error_count"] += 1
+            if len(report["errors"]) < MAX_ERRORS:
+                report["errors"].append({"line": line_num, "error": str(e)})
+            continue
+
+        if item_id is None:
+            by_name.append(values)
+        else:
+            by_id.append((item_id,) + values)
+
+        if len(by_id) + len(by_name) >= CHUNK_SIZE:
+            yield by_id, by_name
+            by_id, by_name = [], []
+
+    if by_id or by_name:
+        yield by_id, by_name
+
+
+def new_report():
+    return {"imported": 0, "errors": [], "error_count": 0}
+
+
+# Upserts rows on db without committing (init_db.py's sample menu).
+# Returns {"imported", "errors", "error_count"}.
+def load_menu(db, rows):
+    report = new_report()
+
+    for by_id, by_name in valid_chunks(rows, report):
+        write_chunk(db, by_id, by_name)
+        report["imported"] += len(by_id) + len(by_name)
+
+    if report["imported"]:
+        bump_catalogue_version(db)
+
+    return report
+
+
+# Imports a file one transaction per chunk. Each chunk is read and
+# validated before the write lock is taken, so a slow upload never
+# holds up checkouts or barista updates. Pass report to still have
+# the counts if reading the file fails part way.
+def import_menu(stream, fmt, report=None):
+    db = get_db()
+    if report is None:
+        report = new_report()
+
+    for by_id, by_name in valid_chunks(read_rows(stream, fmt), report):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            write_chunk(db, by_id, by_name)
+            bump_catalogue_version(db)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        report["imported"] += len(by_id) + len(by_name)
+
+    return report
+
+
+# Turns rows into CSV or JSON Lines text, a chunk at a time
+def write_rows(rows, fields, fmt):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    if fmt == "csv":
+        writer.writerow(fields)
+
+    for count, row in enumerate(rows, 1):
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, row))) + "\n")
+
+        if count % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+# The cursors are iterated, never fetched whole
+def export_menu(fmt):
+    rows = queries.execute(get_db(), "menu.export")
+    return write_rows(rows, MENU_FIELDS, fmt)
+
+
+# One row per order line, optionally for a created_at range
+def export_orders(fmt, start="0000-00-00", end="9999-99-99"):
+    rows = queries.execute(get_db(), "orders.export", (start, end))
+    return write_rows(rows, ORDER_FIELDS, fmt)
@@ -0,0 +1,158 @@
+import threading
+import time
+from flask import Blueprint, Response, g, request, abort, before_render_template, template_rendered
+import queries
+
+
+# Request metrics:
+# Times every request on the app (storefront, auth, admin and barista
+# routes) and exposes the numbers in Prometheus text format on /metrics.
+# For each endpoint we keep:
+#   - request counts by method and status code
+#   - a latency histogram for the whole request
+#   - separate histograms for time spent rendering templates and
+#     running SQL (so we can tell which one is slow during a rush)
+#   - total response bytes
+# The per-query stats from queries.py are exported as well.
+#
+# Numbers are per worker process. /metrics only answers local requests.
+metrics = Blueprint("metrics", __name__)
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HISTOGRAMS = {
+    "puddings_request_duration_seconds": "Time to handle a request",
+    "puddings_template_render_seconds": "Time spent rendering templates per request",
+    "puddings_db_seconds": "Time spent running SQL per request",
+}
+
+_lock = threading.Lock()
+_requests = {}       # (blueprint, endpoint, method, status) -> count
+_response_bytes = {}  # (blueprint, endpoint) -> bytes
+_histograms = {name: {} for name in HISTOGRAMS}  # name -> labels -> [buckets..., sum, count]
+
+
+def observe(name, labels, seconds):
+    series = _histograms[name].get(labels)
+    if series is None:
+        series = _histograms[name][labels] = [0] * (len(BUCKETS) + 2)
+
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            series[i] += 1
+    series[-2] += seconds
+    series[-1] += 1
+
+
+# Forget everything recorded so far (e.g. the warm-up requests, see main.py)
+def reset():
+    with _lock:
+        _requests.clear()
+        _response_bytes.clear()
+        for series in _histograms.values():
+            series.clear()
+
+
+@metrics.before_app_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    g.render_time = 0.0
+    g.render_starts = []
+
+
+# Template timing (Flask signals fire around every render_template call)
+@before_render_template.connect
+def template_started(sender, template, context, **extra):
+    if "render_starts" in g:
+        g.render_starts.append(time.perf_counter())
+
+
+@template_rendered.connect
+def template_finished(sender, template, context, **extra):
+    if g.get("render_starts"):
+        g.render_time += time.perf_counter() - g.render_starts.pop()
+
+
+@metrics.after_app_request
+def record_request(response):
+    if "request_start" not in g:
+        return response
+
+    elapsed = time.perf_counter() - g.request_start
+    labels = (request.blueprint or "storefront", request.endpoint or "unknown")
+
+    # Streamed responses (e.g. the barista event stream) have no length,
+    # and asking for one would read the whole stream into memory
+    size = 0 if response.is_streamed else (response.calculate_content_length() or 0)
+
+    with _lock:
+        key = labels + (request.method, str(response.status_code))
+        _requests[key] = _requests.get(key, 0) + 1
+        _response_bytes[labels] = _response_bytes.get(labels, 0) + size
+
+        observe("puddings_request_duration_seconds", labels, elapsed)
+        observe("puddings_template_render_seconds", labels, g.render_time)
+        observe("puddings_db_seconds", labels, g.get("db_time", 0.0))
+
+    return response
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_text(names, values):
+    return ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+# Builds the Prometheus text exposition of everything above
+def render_metrics():
+    lines = []
+
+    with _lock:
+        lines.append("# HELP puddings_requests_total Requests handled")
+        lines.append("# TYPE puddings_requests_total counter")
+        for key, count in sorted(_requests.items()):
+            labels = label_text(("blueprint", "endpoint", "method", "status"), key)
+            lines.append(f"puddings_requests_total{{{labels}}} {count}")
+
+        lines.append("# HELP puddings_response_bytes_total Response body bytes sent")
+        lines.append("# TYPE puddings_response_bytes_total counter")
+        for key, size in sorted(_response_bytes.items()):
+            labels = label_text(("blueprint", "endpoint"), key)
+            lines.append(f"puddings_response_bytes_total{{{labels}}} {size}")
+
+        for name, help_text in HISTOGRAMS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, series in sorted(_histograms[name].items()):
+                labels = label_text(("blueprint", "endpoint"), key)
+                for bound, count in zip(BUCKETS, series):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+                lines.append(f"{name}_sum{{{labels}}} {series[-2]:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {series[-1]}")
+
+    stats = queries.get_stats()
+
+    lines.append("# HELP puddings_query_calls_total Calls per named query")
+    lines.append("# TYPE puddings_query_calls_total counter")
+    for q in stats:
+        lines.append(f'puddings_query_calls_total{{query="{q["name"]}"}} {q["calls"]}')
+
+    lines.append("# HELP puddings_query_seconds_total Time spent per named query")
+    lines.append("# TYPE puddings_query_seconds_total counter")
+    for q in stats:
+        lines.append(f'puddings_query_seconds_total{{query="{q["name"]}"}} {q["total_ms"] / 1000:.6f}')
+
+    return "\n".join(lines) + "\n"
+
+
+# Prometheus scrape endpoint (local requests only)
+@metrics.route("/metrics")
+def prometheus_metrics():
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return abort(403)
+
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
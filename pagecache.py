@@ -0,0 +1,53 @@
+import hashlib
+import threading
+from functools import wraps
+from flask import Response, make_response, request
+from database import get_setting
+import catalogue
+
+
+# Storefront page cache:
+# The home, about and menu pages look the same for every visitor and
+# only change when the menu or the theme does. The first render of a
+# page is kept in memory with an ETag, keyed by the catalogue version
+# and the active theme. Later visitors get the stored HTML, and
+# browsers that already have it (If-None-Match) get a 304.
+#
+# Admin writes bump the catalogue version or change the theme, which
+# changes the key, so the next request renders a fresh copy.
+# Per-visitor bits (like the cart counter on the menu) are loaded by
+# JavaScript so they never end up in the cached HTML.
+_pages = {}  # path -> {"key", "etag", "body"}
+_lock = threading.Lock()
+
+
+def cached_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (catalogue.get_catalogue()["version"], get_setting("theme"))
+        entry = _pages.get(request.path)
+
+        if entry is None or entry["key"] != key:
+            response = make_response(view(*args, **kwargs))
+
+            # Only plain successful pages are worth keeping
+            if response.status_code != 200:
+                return response
+
+            body = response.get_data()
+            entry = {
+                "key": key,
+                "etag": hashlib.sha1(body).hexdigest(),
+                "body": body,
+            }
+            with _lock:
+                _pages[request.path] = entry
+
+        response = Response(entry["body"], mimetype="text/html")
+        response.set_etag(entry["etag"])
+
+        # Browsers may keep it but must check the ETag before reusing it
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
+
+    return wrapper
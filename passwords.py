@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Password hashing:
+# Checking a password is deliberately slow (scrypt / PBKDF2). It runs on
+# a small pool of [login] hash_workers threads, with at most hash_queue
+# more waiting, so a burst of logins can only ever keep that many CPU
+# cores busy. Logins beyond that are turned away (PoolBusy) instead of
+# tying up request threads the storefront needs.
+#
+# [login] hash_method sets the algorithm and work factor, in werkzeug's
+# format (e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000). Passwords
+# stored with anything else are re-hashed on the next good login.
+
+_pool = {"executor": None, "slots": None}
+_pool_lock = threading.Lock()
+_method_prefix = {}  # configured method -> prefix it produces
+
+# Checked when the username doesn't exist, so that takes as long as a
+# wrong password (no telling which usernames exist from the timing)
+_dummy_hash = {}
+
+
+class PoolBusy(Exception):
+    pass
+
+
+def get_pool():
+    with _pool_lock:
+        if _pool["executor"] is None:
+            workers = current_app.config["LOGIN_HASH_WORKERS"]
+            _pool["executor"] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="passwords")
+            _pool["slots"] = threading.BoundedSemaphore(workers + current_app.config["LOGIN_HASH_QUEUE"])
+        return _pool
+
+
+# Runs fn(*args) on the hashing pool and waits for the result
+def run_hashing(fn, *args):
+    pool = get_pool()
+    if not pool["slots"].acquire(timeout=current_app.config["LOGIN_HASH_WAIT"]):
+        raise PoolBusy()
+
+    try:
+        return pool["executor"].submit(fn, *args).result()
+    finally:
+        pool["slots"].release()
+
+
+def hash_password(password):
+    return run_hashing(generate_password_hash, password, current_app.config["LOGIN_HASH_METHOD"])
+
+
+# Checks password against stored (None = no such user)
+def check_password(stored, password):
+    if stored is None:
+        method = current_app.config["LOGIN_HASH_METHOD"]
+        if method not in _dummy_hash:
+            _dummy_hash[method] = hash_password("not a real password")
+        run_hashing(check_password_hash, _dummy_hash[method], password)
+        return False
+
+    return run_hashing(check_password_hash, stored, password)
+
+
+# True if stored wasn't made with the configured method / work factor.
+# Raises PoolBusy like the rest.
+def needs_rehash(stored):
+    method = current_app.config["LOGIN_HASH_METHOD"]
+    if method not in _method_prefix:
+        # werkzeug fills in defaults ("scrypt" -> "scrypt:32768:8:1"),
+        # so compare with what the configured method really produces.
+        # That's one full (slow) hash, so it runs on the pool too.
+        _method_prefix[method] = run_hashing(generate_password_hash, "", method).split("$", 1)[0]
+
+    return stored.split("$", 1)[0] != _method_prefix[method]
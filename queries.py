@@ -0,0 +1,535 @@
+import logging
+import threading
+import time
+from collections import deque
+from flask import current_app, has_app_context, has_request_context, g
+
+
+# Query registry:
+# Every SQL statement the app runs lives here under a name, and is run
+# through execute()/fetch_one()/fetch_all() below. That gives us one
+# place to read all the SQL, and per-query stats: call count, total
+# time, p50/p95/p99 latency and rows returned (see /admin/metrics).
+#
+# Queries slower than SLOW_QUERY_MS (etc/defaults.cfg) are logged, with
+# the bound parameters replaced by their types.
+
+# How each analytics grain turns an order's created_at into a bucket
+ROLLUP_BUCKETS = {
+    "hour": "strftime('%Y-%m-%d %H:00', o.created_at)",
+    "day": "DATE(o.created_at)",
+}
+
+# Upper edges (seconds) of the stage duration histogram buckets, plus
+# one open-ended bucket after the last. p50/p95 are read off these.
+STAGE_BOUNDS = [30, 60, 120, 180, 240, 300, 420, 600, 900, 1200, 1800, 2700, 3600, 7200]
+STAGE_SLOT = "CASE " + " ".join(
+    f"WHEN s.seconds <= {bound} THEN {slot}" for slot, bound in enumerate(STAGE_BOUNDS)
+) + f" ELSE {len(STAGE_BOUNDS)} END"
+
+QUERIES = {
+    # Menu items
+    "menu.all": "SELECT * FROM menu_items ORDER BY id",
+    "menu.get": "SELECT * FROM menu_items WHERE id=?",
+    "menu.get_many": """
+        SELECT * FROM menu_items
+        WHERE id IN (SELECT value FROM json_each(?))
+    """,
+    "menu.insert": """
+        INSERT INTO menu_items (name, price, category, description, image)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "menu.update": """
+        UPDATE menu_items
+        SET name=?, price=?, category=?, description=?, image=?
+        WHERE id=?
+    """,
+    "menu.delete": "DELETE FROM menu_items WHERE id=?",
+    # Bulk import / export (see menuio.py)
+    "menu.upsert": """
+        INSERT INTO menu_items (id, name, price, category, description, image)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            name = excluded.name,
+            price = excluded.price,
+            category = excluded.category,
+            description = excluded.description,
+            image = excluded.image
+    """,
+    "menu.insert_if_new": """
+        INSERT INTO menu_items (name, price, category, description, image)
+        SELECT ?, ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM menu_items WHERE name = ?)
+    """,
+    "menu.update_by_name": """
+        UPDATE menu_items
+        SET price=?, category=?, description=?, image=?
+        WHERE name=?
+    """,
+    "menu.export": """
+        SELECT id, name, price, category, description, image
+        FROM menu_items ORDER BY id
+    """,
+    "menu.categories": "SELECT DISTINCT category FROM menu_items ORDER BY category",
+    # One page of the admin listing, after the :after id (keyset paging).
+    # Empty :category / :search mean "no filter".
+    "menu.search_page": """
+        SELECT * FROM menu_items
+        WHERE id > :after
+          AND (:category = '' OR category = :category)
+          AND (:search = '' OR id IN (
+                  SELECT rowid FROM menu_items_fts
+                  WHERE menu_items_fts MATCH :search
+              ))
+        ORDER BY id
+        LIMIT :limit
+    """,
+    # Best matches first, for the type-ahead
+    "menu.suggest": """
+        SELECT m.id, m.name, m.category, m.price
+        FROM menu_items_fts f
+        JOIN menu_items m ON m.id = f.rowid
+        WHERE menu_items_fts MATCH ?
+        ORDER BY f.rank
+        LIMIT ?
+    """,
+
+    # Image variants (see images.py)
+    "images.all_variants": "SELECT image, width, format, path FROM image_variants ORDER BY image, width",
+    "images.has_variants": "SELECT 1 FROM image_variants WHERE image = ? LIMIT 1",
+    "images.insert_variant": """
+        INSERT OR IGNORE INTO image_variants (image, width, format, path)
+        VALUES (?, ?, ?, ?)
+    """,
+
+    # Orders
+    "orders.insert": """
+        INSERT INTO orders (customer_name, items, status, change_seq, idempotency_key)
+        VALUES (?, ?, 'pending',
+                (SELECT COALESCE(MAX(change_seq), 0) + 1 FROM orders), ?)
+    """,
+    "orders.by_idempotency_key": "SELECT id FROM orders WHERE idempotency_key = ?",
+    "orders.all": "SELECT * FROM orders ORDER BY created_at",
+    "orders.active": """
+        SELECT * FROM orders
+        WHERE status IN ('pending', 'progress', 'ready')
+        ORDER BY created_at
+    """,
+    "orders.changed_since": """
+        SELECT * FROM orders
+        WHERE change_seq > ?
+        ORDER BY change_seq
+        LIMIT ?
+    """,
+    "orders.cursor": "SELECT COALESCE(MAX(change_seq), 0) FROM orders",
+    "orders.export": """
+        SELECT o.id, o.created_at, o.status, o.customer_name,
+               oi.menu_item_id, oi.name, oi.qty, oi.unit_price
+        FROM all_orders o
+        JOIN all_order_items oi ON oi.order_id = o.id
+        WHERE o.created_at >= ? AND o.created_at < ?
+        ORDER BY o.id, oi.id
+    """,
+    "orders.get": "SELECT * FROM orders WHERE id=?",
+    "orders.status": "SELECT status, version FROM orders WHERE id=?",
+    # Only if the version is still the one we read
+    "orders.update_status": """
+        UPDATE orders
+        SET status=?,
+            version=version + 1,
+            change_seq=(SELECT MAX(change_seq) + 1 FROM orders)
+        WHERE id=? AND version=?
+    """,
+    "order_items.insert": """
+        INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "order_items.for_order": """
+        SELECT menu_item_id AS id, name, qty, unit_price AS price
+        FROM order_items WHERE order_id = ? ORDER BY id
+    """,
+
+    # Order archival (see archive.py)
+    # The newest change_seq always stays behind: the barista board's
+    # cursor and the next change_seq are both taken from it.
+    "archive.pick": """
+        SELECT id FROM orders
+        WHERE status = 'collected' AND created_at < ?
+          AND change_seq < (SELECT MAX(change_seq) FROM orders)
+        ORDER BY id
+        LIMIT ?
+    """,
+    "archive.copy_orders": """
+        INSERT INTO orders_archive (id, customer_name, items, status, created_at, change_seq, idempotency_key, version)
+        SELECT id, customer_name, items, status, created_at, change_seq, idempotency_key, version
+        FROM orders WHERE id IN (SELECT value FROM json_each(?))
+    """,
+    "archive.copy_items": """
+        INSERT INTO order_items_archive (id, order_id, menu_item_id, name, qty, unit_price)
+        SELECT id, order_id, menu_item_id, name, qty, unit_price
+        FROM order_items WHERE order_id IN (SELECT value FROM json_each(?))
+    """,
+    "archive.delete_items": "DELETE FROM order_items WHERE order_id IN (SELECT value FROM json_each(?))",
+    "archive.delete_orders": "DELETE FROM orders WHERE id IN (SELECT value FROM json_each(?))",
+
+    # Server-side carts (see carts.py)
+    "carts.get": "SELECT items FROM carts WHERE id = ? AND updated_at >= ?",
+    "carts.save": """
+        INSERT INTO carts (id, items, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET items = excluded.items, updated_at = excluded.updated_at
+    """,
+    "carts.delete": "DELETE FROM carts WHERE id = ?",
+    "carts.sweep": "DELETE FROM carts WHERE updated_at < ?",
+
+    # Users
+    "users.by_username": "SELECT * FROM users WHERE username = ?",
+    "users.set_password": "UPDATE users SET password = ? WHERE id = ?",
+
+    # Login rate limits (see ratelimit.py):
+    # Refill the bucket for the time since the last attempt (capped at
+    # :burst), then take a token if there is a whole one.
+    # All the expressions see the row as it was before this update.
+    "rate_limits.take": """
+        INSERT INTO rate_limits (key, tokens, updated_at, allowed)
+        VALUES (:key, :burst - 1, :now, 1)
+        ON CONFLICT(key) DO UPDATE SET
+            tokens = MIN(:burst, tokens + (:now - updated_at) * :rate)
+                     - (MIN(:burst, tokens + (:now - updated_at) * :rate) >= 1),
+            allowed = MIN(:burst, tokens + (:now - updated_at) * :rate) >= 1,
+            updated_at = :now
+        RETURNING tokens, allowed
+    """,
+    "rate_limits.sweep": "DELETE FROM rate_limits WHERE updated_at < ?",
+
+    # Settings
+    "settings.all": "SELECT key, value FROM settings",
+    "settings.set": "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+    "settings.catalogue_version": """
+        SELECT value FROM settings WHERE key='catalogue_version'
+    """,
+    "settings.bump_catalogue_version": """
+        INSERT INTO settings (key, value) VALUES ('catalogue_version', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    """,
+
+    # Analytics rollups (see rollups.py)
+    "rollups.clear_orders": "DELETE FROM order_rollups",
+    "rollups.clear_items": "DELETE FROM item_rollups",
+    "rollups.clear_stages": "DELETE FROM stage_rollups",
+    "rollups.clear_flows": "DELETE FROM flow_rollups",
+    "rollups.stored_orders": """
+        SELECT grain, bucket, orders, collected, revenue
+        FROM order_rollups WHERE grain = ?
+    """,
+    "rollups.stored_items": """
+        SELECT grain, bucket, item_key, lines, qty
+        FROM item_rollups WHERE grain = ?
+    """,
+    "rollups.totals": """
+        SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(revenue), 0)
+        FROM order_rollups
+        WHERE grain = 'day' AND bucket >= ? AND bucket < ?
+    """,
+    "rollups.orders_per_bucket": """
+        SELECT bucket, orders
+        FROM order_rollups
+        WHERE grain = ? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+    """,
+    "rollups.popular_items": """
+        SELECT COALESCE(m.name, MAX(r.name)) AS name,
+               SUM(r.lines) AS count
+        FROM item_rollups r
+        LEFT JOIN menu_items m ON m.id = r.menu_item_id
+        WHERE r.grain = 'day' AND r.bucket >= ? AND r.bucket < ?
+        GROUP BY r.item_key
+        ORDER BY count DESC
+    """,
+    "rollups.stored_stages": """
+        SELECT grain, bucket, stage, slot, count, seconds
+        FROM stage_rollups WHERE grain = ?
+    """,
+    "rollups.stored_flows": """
+        SELECT grain, bucket, status, entered, left_count
+        FROM flow_rollups WHERE grain = ?
+    """,
+    "rollups.stage_histogram": """
+        SELECT stage, slot, SUM(count), SUM(seconds)
+        FROM stage_rollups
+        WHERE grain = ? AND bucket >= ? AND bucket < ?
+        GROUP BY stage, slot
+        ORDER BY stage, slot
+    """,
+    "rollups.depth_before": """
+        SELECT status, SUM(entered - left_count)
+        FROM flow_rollups
+        WHERE grain = ? AND bucket < ?
+        GROUP BY status
+    """,
+    "rollups.flows": """
+        SELECT bucket, status, entered - left_count
+        FROM flow_rollups
+        WHERE grain = ? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+    """,
+    "rollups.orders_by_hour": """
+        SELECT CAST(substr(bucket, 12, 2) AS INTEGER) AS hour, SUM(orders)
+        FROM order_rollups
+        WHERE grain = 'hour' AND bucket >= ? AND bucket < ?
+        GROUP BY hour
+        ORDER BY hour
+    """,
+
+    # Order transitions (append-only, see rollups.py)
+    "transitions.created": """
+        INSERT INTO order_transitions (order_id, from_status, to_status, at)
+        SELECT id, NULL, status, created_at FROM orders WHERE id = ?
+    """,
+    "transitions.insert": """
+        INSERT INTO order_transitions (order_id, from_status, to_status)
+        VALUES (?, ?, ?)
+    """,
+}
+
+# One set of rollup statements per grain, e.g. "rollups.add_order.hour"
+for grain, bucket in ROLLUP_BUCKETS.items():
+    # Expected rows straight from the raw tables, archived orders
+    # included (rebuild + check)
+    QUERIES[f"rollups.compute_orders.{grain}"] = f"""
+        SELECT '{grain}', {bucket} AS bucket,
+               COUNT(*),
+               SUM(o.status = 'collected'),
+               COALESCE(SUM(t.total), 0)
+        FROM all_orders o
+        LEFT JOIN (
+            SELECT order_id, SUM(qty * COALESCE(unit_price, 0)) AS total
+            FROM all_order_items
+            GROUP BY order_id
+        ) t ON t.order_id = o.id
+        GROUP BY bucket
+    """
+    QUERIES[f"rollups.compute_items.{grain}"] = f"""
+        SELECT '{grain}', {bucket} AS bucket,
+               COALESCE(CAST(oi.menu_item_id AS TEXT), 'name:' || oi.name) AS item_key,
+               MAX(oi.menu_item_id), MAX(oi.name),
+               COUNT(*), SUM(oi.qty)
+        FROM all_order_items oi
+        JOIN all_orders o ON o.id = oi.order_id
+        GROUP BY bucket, item_key
+    """
+    QUERIES[f"rollups.rebuild_orders.{grain}"] = f"""
+        INSERT INTO order_rollups (grain, bucket, orders, collected, revenue)
+        {QUERIES[f"rollups.compute_orders.{grain}"]}
+    """
+    QUERIES[f"rollups.rebuild_items.{grain}"] = f"""
+        INSERT INTO item_rollups (grain, bucket, item_key, menu_item_id, name, lines, qty)
+        {QUERIES[f"rollups.compute_items.{grain}"]}
+    """
+
+    # Incremental updates
+    QUERIES[f"rollups.add_order.{grain}"] = f"""
+        INSERT INTO order_rollups (grain, bucket, orders, collected, revenue)
+        SELECT '{grain}', {bucket}, 1, o.status = 'collected',
+               (SELECT COALESCE(SUM(qty * COALESCE(unit_price, 0)), 0)
+                FROM order_items WHERE order_id = o.id)
+        FROM orders o
+        WHERE o.id = ?
+        ON CONFLICT(grain, bucket) DO UPDATE SET
+            orders = orders + excluded.orders,
+            collected = collected + excluded.collected,
+            revenue = revenue + excluded.revenue
+    """
+    QUERIES[f"rollups.add_order_items.{grain}"] = f"""
+        INSERT INTO item_rollups (grain, bucket, item_key, menu_item_id, name, lines, qty)
+        SELECT '{grain}', {bucket},
+               COALESCE(CAST(oi.menu_item_id AS TEXT), 'name:' || oi.name),
+               oi.menu_item_id, oi.name, 1, oi.qty
+        FROM order_items oi
+        JOIN orders o ON o.id = oi.order_id
+        WHERE oi.order_id = ?
+        ON CONFLICT(grain, bucket, item_key) DO UPDATE SET
+            name = excluded.name,
+            lines = lines + excluded.lines,
+            qty = qty + excluded.qty
+    """
+    QUERIES[f"rollups.add_collected.{grain}"] = f"""
+        UPDATE order_rollups
+        SET collected = collected + ?
+        WHERE grain = '{grain}'
+          AND bucket = (SELECT {bucket} FROM orders o WHERE o.id = ?)
+    """
+
+    # Stage timings, bucketed by when the order left the stage.
+    # A stage lasts from the transition into it to the next one out.
+    at = bucket.replace("o.created_at", "s.at")
+    QUERIES[f"rollups.compute_stages.{grain}"] = f"""
+        SELECT '{grain}', {at} AS bucket, s.stage, {STAGE_SLOT} AS slot,
+               COUNT(*), SUM(s.seconds)
+        FROM (
+            SELECT at, from_status AS stage,
+                   (julianday(at) - julianday(LAG(at) OVER (
+                       PARTITION BY order_id ORDER BY id
+                   ))) * 86400 AS seconds
+            FROM order_transitions
+        ) s
+        WHERE s.stage IS NOT NULL AND s.seconds IS NOT NULL
+        GROUP BY bucket, s.stage, slot
+    """
+    QUERIES[f"rollups.compute_flows.{grain}"] = f"""
+        SELECT '{grain}', {at} AS bucket, s.status,
+               SUM(s.entered), SUM(s.left_count)
+        FROM (
+            SELECT at, to_status AS status, 1 AS entered, 0 AS left_count
+            FROM order_transitions
+            UNION ALL
+            SELECT at, from_status, 0, 1
+            FROM order_transitions WHERE from_status IS NOT NULL
+        ) s
+        GROUP BY bucket, s.status
+    """
+    QUERIES[f"rollups.rebuild_stages.{grain}"] = f"""
+        INSERT INTO stage_rollups (grain, bucket, stage, slot, count, seconds)
+        {QUERIES[f"rollups.compute_stages.{grain}"]}
+    """
+    QUERIES[f"rollups.rebuild_flows.{grain}"] = f"""
+        INSERT INTO flow_rollups (grain, bucket, status, entered, left_count)
+        {QUERIES[f"rollups.compute_flows.{grain}"]}
+    """
+
+    # Incremental: one transition (by its id)
+    QUERIES[f"rollups.add_stage.{grain}"] = f"""
+        INSERT INTO stage_rollups (grain, bucket, stage, slot, count, seconds)
+        SELECT '{grain}', {at}, s.stage, {STAGE_SLOT}, 1, s.seconds
+        FROM (
+            SELECT t.at, t.from_status AS stage,
+                   (julianday(t.at) - julianday(p.at)) * 86400 AS seconds
+            FROM order_transitions t
+            JOIN order_transitions p ON p.id = (
+                SELECT MAX(id) FROM order_transitions
+                WHERE order_id = t.order_id AND id < t.id
+            )
+            WHERE t.id = ? AND t.from_status IS NOT NULL
+        ) s
+        WHERE true
+        ON CONFLICT(grain, bucket, stage, slot) DO UPDATE SET
+            count = count + excluded.count,
+            seconds = seconds + excluded.seconds
+    """
+    QUERIES[f"rollups.add_flow.{grain}"] = f"""
+        INSERT INTO flow_rollups (grain, bucket, status, entered, left_count)
+        SELECT '{grain}', {at}, s.status, s.entered, s.left_count
+        FROM (
+            SELECT at, to_status AS status, 1 AS entered, 0 AS left_count
+            FROM order_transitions WHERE id = :id
+            UNION ALL
+            SELECT at, from_status, 0, 1
+            FROM order_transitions WHERE id = :id AND from_status IS NOT NULL
+        ) s
+        WHERE true
+        ON CONFLICT(grain, bucket, status) DO UPDATE SET
+            entered = entered + excluded.entered,
+            left_count = left_count + excluded.left_count
+    """
+
+
+# Stats:
+# name -> calls, total seconds, rows and the latest SAMPLE_SIZE timings
+# (the percentiles are worked out from those samples)
+SAMPLE_SIZE = 1000
+
+_stats = {}
+_stats_lock = threading.Lock()
+log = logging.getLogger("queries")
+
+
+def record(name, seconds, rows, params):
+    # Per-request total, picked up by the request metrics (metrics.py)
+    if has_request_context():
+        g.db_time = g.get("db_time", 0.0) + seconds
+
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = {
+                "calls": 0,
+                "total": 0.0,
+                "rows": 0,
+                "samples": deque(maxlen=SAMPLE_SIZE),
+            }
+        stats["calls"] += 1
+        stats["total"] += seconds
+        stats["rows"] += max(rows, 0)
+        stats["samples"].append(seconds)
+
+    slow_ms = current_app.config.get("SLOW_QUERY_MS") if has_app_context() else None
+    if slow_ms and seconds * 1000 >= slow_ms:
+        # Never log the values themselves, only what kind they were
+        if isinstance(params, dict):
+            redacted = {key: type(value).__name__ for key, value in params.items()}
+        else:
+            redacted = [type(p).__name__ for p in params]
+        log.warning("Slow query %s took %.1f ms (params: %s)", name, seconds * 1000, redacted)
+
+
+def execute(db, name, params=()):
+    start = time.perf_counter()
+    cursor = db.execute(QUERIES[name], params)
+    record(name, time.perf_counter() - start, cursor.rowcount, params)
+    return cursor
+
+
+def execute_many(db, name, rows):
+    start = time.perf_counter()
+    cursor = db.executemany(QUERIES[name], rows)
+    record(name, time.perf_counter() - start, cursor.rowcount, ())
+    return cursor
+
+
+def fetch_one(db, name, params=()):
+    start = time.perf_counter()
+    row = db.execute(QUERIES[name], params).fetchone()
+    record(name, time.perf_counter() - start, 1 if row else 0, params)
+    return row
+
+
+def fetch_all(db, name, params=()):
+    start = time.perf_counter()
+    rows = db.execute(QUERIES[name], params).fetchall()
+    record(name, time.perf_counter() - start, len(rows), params)
+    return rows
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+# Snapshot of the stats, slowest (by total time) first.
+# Times are in milliseconds.
+def get_stats():
+    with _stats_lock:
+        snapshot = {
+            name: (stats["calls"], stats["total"], stats["rows"], sorted(stats["samples"]))
+            for name, stats in _stats.items()
+        }
+
+    report = []
+    for name, (calls, total, rows, samples) in snapshot.items():
+        report.append({
+            "name": name,
+            "calls": calls,
+            "total_ms": round(total * 1000, 3),
+            "avg_ms": round(total * 1000 / calls, 3),
+            "p50_ms": round(percentile(samples, 50) * 1000, 3),
+            "p95_ms": round(percentile(samples, 95) * 1000, 3),
+            "p99_ms": round(percentile(samples, 99) * 1000, 3),
+            "rows": rows,
+        })
+
+    return sorted(report, key=lambda r: r["total_ms"], reverse=True)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
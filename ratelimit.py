@@ -0,0 +1,39 @@
+import random
+import time
+from database import get_db
+import queries
+
+
+# Token bucket rate limiting:
+# Every key ("ip:1.2.3.4", "user:testbarista") has a bucket holding up
+# to `burst` tokens that refills at `per_minute` tokens a minute. Each
+# attempt takes a token; an empty bucket means "slow down".
+#
+# Buckets live in the rate_limits table, so every worker process (and
+# every server thread) shares them. Checking and taking a token is one
+# UPSERT, so two workers can never both spend the last token.
+
+# Roughly one check in this many also drops buckets idle for a day
+SWEEP_CHANCE = 500
+IDLE_SECONDS = 24 * 60 * 60
+
+
+# Takes a token from key's bucket.
+# Returns 0 if allowed, otherwise the seconds until a token is back.
+def take(key, burst, per_minute):
+    db = get_db()
+    now = time.time()
+    rate = per_minute / 60
+
+    row = queries.fetch_one(db, "rate_limits.take", {
+        "key": key, "burst": burst, "rate": rate, "now": now
+    })
+
+    if random.randrange(SWEEP_CHANCE) == 0:
+        queries.execute(db, "rate_limits.sweep", (now - IDLE_SECONDS,))
+
+    db.commit()
+
+    if row["allowed"]:
+        return 0
+    return (1 - row["tokens"]) / rate if rate else IDLE_SECONDS
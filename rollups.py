@@ -0,0 +1,221 @@
+import queries
+
+
+# Analytics rollups:
+# Pre-aggregated order counts, revenue and item quantities per hour and
+# per day. database.py keeps them up to date as orders are created or
+# change status, so the analytics page only ever reads these small
+# tables instead of scanning the whole order history.
+#
+# Every function takes the connection to use, so the updates happen
+# inside the caller's transaction (and init_db.py can use them too).
+# The SQL lives in queries.py under "rollups.*".
+#
+# Order timings come from order_transitions, an append-only log with a
+# row (and timestamp) for every status an order enters. Each new row
+# also updates stage_rollups (a histogram of how long orders spent in
+# each status) and flow_rollups (orders entering / leaving each status,
+# whose running total is the queue depth).
+GRAINS = list(queries.ROLLUP_BUCKETS)
+
+# Statuses an order waits in, as shown on the analytics page
+STAGES = ["pending", "progress", "ready"]
+
+
+# Logs a transition and adds it to the timing rollups
+def record_transition(db, order_id, old_status, new_status):
+    if old_status is None:
+        cursor = queries.execute(db, "transitions.created", (order_id,))
+    else:
+        cursor = queries.execute(db, "transitions.insert", (order_id, old_status, new_status))
+
+    for grain in GRAINS:
+        queries.execute(db, f"rollups.add_stage.{grain}", (cursor.lastrowid,))
+        queries.execute(db, f"rollups.add_flow.{grain}", {"id": cursor.lastrowid})
+
+
+# New order: add it (and its lines) to its hour and day buckets
+def record_order(db, order_id):
+    for grain in GRAINS:
+        queries.execute(db, f"rollups.add_order.{grain}", (order_id,))
+        queries.execute(db, f"rollups.add_order_items.{grain}", (order_id,))
+
+    record_transition(db, order_id, None, "pending")
+
+
+# Status change: every one is timed, but only moving into or out of
+# "collected" changes the order counts
+def record_status_change(db, order_id, old_status, new_status):
+    record_transition(db, order_id, old_status, new_status)
+
+    if (old_status == "collected") == (new_status == "collected"):
+        return
+
+    delta = 1 if new_status == "collected" else -1
+
+    for grain in GRAINS:
+        queries.execute(db, f"rollups.add_collected.{grain}", (delta, order_id))
+
+
+# Recompute every rollup from the raw orders (one transaction).
+# Safe to run at any time, e.g. after fixing data by hand.
+def rebuild(db):
+    with db:
+        queries.execute(db, "rollups.clear_orders")
+        queries.execute(db, "rollups.clear_items")
+        queries.execute(db, "rollups.clear_stages")
+        queries.execute(db, "rollups.clear_flows")
+
+        for grain in GRAINS:
+            queries.execute(db, f"rollups.rebuild_orders.{grain}")
+            queries.execute(db, f"rollups.rebuild_items.{grain}")
+            queries.execute(db, f"rollups.rebuild_stages.{grain}")
+            queries.execute(db, f"rollups.rebuild_flows.{grain}")
+
+
+# Compare the stored rollups with freshly computed ones.
+# Returns a list of (table, key) pairs that don't match.
+def check(db):
+    problems = []
+
+    for grain in GRAINS:
+        expected = {
+            tuple(row[:2]): (row[2], row[3], round(row[4], 2))
+            for row in queries.fetch_all(db, f"rollups.compute_orders.{grain}")
+        }
+        stored = {
+            tuple(row[:2]): (row[2], row[3], round(row[4], 2))
+            for row in queries.fetch_all(db, "rollups.stored_orders", (grain,))
+        }
+        problems += [
+            ("order_rollups", key)
+            for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        ]
+
+        expected = {
+            tuple(row[:3]): (row[5], row[6])
+            for row in queries.fetch_all(db, f"rollups.compute_items.{grain}")
+        }
+        stored = {
+            tuple(row[:3]): (row[3], row[4])
+            for row in queries.fetch_all(db, "rollups.stored_items", (grain,))
+        }
+        problems += [
+            ("item_rollups", key)
+            for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        ]
+
+        expected = {
+            tuple(row[:4]): (row[4], round(row[5], 1))
+            for row in queries.fetch_all(db, f"rollups.compute_stages.{grain}")
+        }
+        stored = {
+            tuple(row[:4]): (row[4], round(row[5], 1))
+            for row in queries.fetch_all(db, "rollups.stored_stages", (grain,))
+        }
+        problems += [
+            ("stage_rollups", key)
+            for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        ]
+
+        expected = {
+            tuple(row[:3]): (row[3], row[4])
+            for row in queries.fetch_all(db, f"rollups.compute_flows.{grain}")
+        }
+        stored = {
+            tuple(row[:3]): (row[3], row[4])
+            for row in queries.fetch_all(db, "rollups.stored_flows", (grain,))
+        }
+        problems += [
+            ("flow_rollups", key)
+            for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        ]
+
+    return sorted(problems)
+
+
+# Analytics readers:
+# start/end are "YYYY-MM-DD" strings (end is exclusive), the bucket
+# labels sort as text so a plain range comparison works for both grains.
+def get_totals(db, start, end):
+    row = queries.fetch_one(db, "rollups.totals", (start, end))
+    return row[0], row[1]
+
+
+def get_orders_per_bucket(db, grain, start, end):
+    return [
+        (row[0], row[1])
+        for row in queries.fetch_all(db, "rollups.orders_per_bucket", (grain, start, end))
+    ]
+
+
+# Most popular items, shown under their current menu name
+def get_popular_items(db, start, end):
+    return [
+        (row[0], row[1])
+        for row in queries.fetch_all(db, "rollups.popular_items", (start, end))
+    ]
+
+
+# Orders placed in each hour of the day (0-23), over the whole range
+def get_orders_by_hour(db, start, end):
+    counts = dict(queries.fetch_all(db, "rollups.orders_by_hour", (start, end)))
+    return [(hour, counts.get(hour, 0)) for hour in range(24)]
+
+
+# Median and 95th percentile time (seconds) spent in each stage.
+# Read off the histogram, so each is the upper edge of the bucket it
+# falls in (None past the last edge). Returns {stage: {...}}.
+def get_stage_timings(db, grain, start, end):
+    histograms = {stage: [] for stage in STAGES}
+    for row in queries.fetch_all(db, "rollups.stage_histogram", (grain, start, end)):
+        if row[0] in histograms:
+            histograms[row[0]].append((row[1], row[2], row[3]))
+
+    timings = {}
+    for stage, buckets in histograms.items():
+        count = sum(bucket[1] for bucket in buckets)
+        timings[stage] = {
+            "count": count,
+            "mean": sum(bucket[2] for bucket in buckets) / count if count else None,
+            "p50": percentile(buckets, count, 0.50),
+            "p95": percentile(buckets, count, 0.95),
+        }
+    return timings
+
+
+def percentile(buckets, count, fraction):
+    if not count:
+        return None
+
+    seen = 0
+    for slot, bucket_count, _ in buckets:
+        seen += bucket_count
+        if seen >= fraction * count:
+            break
+
+    return queries.STAGE_BOUNDS[slot] if slot < len(queries.STAGE_BOUNDS) else None
+
+
+# Orders waiting in each stage at the end of every bucket:
+# [(bucket, {stage: depth})]. The rollups hold entries minus exits per
+# bucket, so this adds everything before the range and keeps a running
+# total through it.
+def get_queue_depth(db, grain, start, end):
+    depth = {stage: 0 for stage in STAGES}
+    for status, change in queries.fetch_all(db, "rollups.depth_before", (grain, start)):
+        if status in depth:
+            depth[status] = change
+
+    series = []
+    for bucket, status, change in queries.fetch_all(db, "rollups.flows", (grain, start, end)):
+        if not series or series[-1][0] != bucket:
+            series.append((bucket, dict(depth)))
+        if status in depth:
+            depth[status] += change
+            series[-1][1][status] = depth[status]
+    return series
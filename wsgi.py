@@ -0,0 +1,10 @@
+from main import app, warm_up
+
+
+# Production entry point:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# gunicorn.conf.py preloads this module in the master process, so the
+# caches and templates warmed here are shared by every worker it forks.
+# (python main.py still runs Flask's development server.)
+warm_up(app)